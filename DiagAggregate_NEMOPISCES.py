@@ -0,0 +1,163 @@
+import numpy as np
+
+# Streaming temporal aggregation (climatologies, annual means) of the diagnostics.
+# An accumulator holds, for each grouping ('month', 'season' or 'year'), each group and each diagnostic, the running
+# weighted mean and sum of squared deviations (West, 1979), min, max and count of valid records.
+# Records are weighted by their duration (time_counter_bounds). Accumulators of different files can be merged (Chan et al., 1979),
+# so that each file is accumulated where it is processed and only the accumulators travel.
+# An accumulator is a dictionnary of numpy arrays, so that it can be returned by worker processes.
+# xarray is only needed to write the aggregates.
+
+groupings=['month','season','year']
+
+
+def recordweights(x):
+    """
+    Weight of each record of X : its duration (s) from time_counter_bounds, or 1 if the bounds are not available.
+    """
+    if 'time_counter_bounds' not in x.variables:
+        return np.ones(x.sizes['time_counter'])
+    b=x['time_counter_bounds'].transpose('time_counter',...).values
+    d=b[:,1]-b[:,0]
+    if isinstance(d[0], np.timedelta64) or np.issubdtype(np.asarray(d).dtype, np.timedelta64):
+        return np.asarray(d, dtype='timedelta64[ns]').astype('float64')/1e9
+    # cftime dates give datetime.timedelta
+    return np.array([e.total_seconds() for e in d])
+
+
+def groupkeys(time, grouping):
+    """
+    Group of each record of TIME (xarray DataArray of dates), for GROUPING in 'month', 'season' and 'year'.
+    """
+    return list(getattr(time.dt, grouping).values)
+
+
+def newaccumulator(groupby):
+    """
+    Empty accumulator for the groupings in GROUPBY (eg. ['month','year']).
+    """
+    return {'groupby' : list(groupby), 'groups' : {g : {} for g in groupby}, 'attrs' : {}, 'coords' : {}}
+
+
+def _newstats(shape):
+    return {'w' : np.zeros(shape), 'mean' : np.zeros(shape), 'm2' : np.zeros(shape),
+            'min' : np.full(shape, np.nan), 'max' : np.full(shape, np.nan), 'count' : np.zeros(shape, dtype='int32')}
+
+
+def accumulate(acc, x, dlist, weights=None):
+    """
+    Add the records of the diagnostics DLIST of X to the accumulator ACC (in place).
+
+    Args:
+        acc (dict): accumulator (see newaccumulator)
+        x (xarray): diagnostics, along time_counter
+        dlist (list of str): diagnostics to accumulate
+        weights (array): weight of each record of X (see recordweights). Records are equally weighted by default.
+
+    Returns:
+        dict : ACC
+    """
+    nt=x.sizes['time_counter']
+    weights=np.ones(nt) if weights is None else np.asarray(weights, dtype='float64')
+    for c in x.coords:
+        if c not in acc['coords'] and 'time_counter' not in x[c].dims and x[c].dims:
+            acc['coords'][c]=(x[c].dims, x[c].values, dict(x[c].attrs))
+    for v in dlist:
+        a=x[v].transpose('time_counter',...)
+        acc['attrs'][v]=(a.dims[1:], dict(a.attrs))
+        a=a.values
+        for groupby in acc['groupby']:
+            stats=acc['groups'][groupby]
+            for t, g in enumerate(groupkeys(x['time_counter'], groupby)):
+                s=stats.setdefault(g, {}).setdefault(v, _newstats(a.shape[1:]))
+                at=a[t]
+                valid=~np.isnan(at)
+                w=np.where(valid, weights[t], 0.)
+                s['w']+=w
+                delta=np.where(valid, at-s['mean'], 0.)
+                s['mean']+=np.divide(w*delta, s['w'], out=np.zeros_like(delta), where=s['w']>0)
+                s['m2']+=w*delta*np.where(valid, at-s['mean'], 0.)
+                s['min']=np.fmin(s['min'], at)
+                s['max']=np.fmax(s['max'], at)
+                s['count']+=valid
+    return acc
+
+
+def mergeaccumulators(acc, other):
+    """
+    Merge the accumulator OTHER in ACC (in place), eg. the accumulators of files processed by different workers.
+
+    Returns:
+        dict : ACC
+    """
+    acc['attrs'].update(other['attrs'])
+    for c in other['coords']:
+        acc['coords'].setdefault(c, other['coords'][c])
+    for groupby in acc['groupby']:
+        for g, gstats in other['groups'][groupby].items():
+            for v, o in gstats.items():
+                s=acc['groups'][groupby].setdefault(g, {}).get(v)
+                if s is None:
+                    acc['groups'][groupby][g][v]=o
+                    continue
+                w=s['w']+o['w']
+                delta=o['mean']-s['mean']
+                s['mean']+=np.divide(delta*o['w'], w, out=np.zeros_like(delta), where=w>0)
+                s['m2']+=o['m2']+np.divide(delta**2*s['w']*o['w'], w, out=np.zeros_like(delta), where=w>0)
+                s['w']=w
+                s['min']=np.fmin(s['min'], o['min'])
+                s['max']=np.fmax(s['max'], o['max'])
+                s['count']+=o['count']
+    return acc
+
+
+def aggregates(acc, groupby):
+    """
+    Weighted mean, variance, min, max and count of valid records of each diagnostic, for each group of GROUPBY.
+
+    Returns:
+        xarray : variables V (mean), V_var, V_min, V_max and V_count, along the dimension GROUPBY
+    """
+    import xarray as xr
+    stats=acc['groups'][groupby]
+    keys=sorted(stats, key=lambda g : ['DJF','MAM','JJA','SON'].index(g) if groupby=='season' else g)
+    x=xr.Dataset(coords={c : xr.Variable(*acc['coords'][c]) for c in acc['coords']})
+    x=x.assign_coords({groupby : keys})
+    for v, (dims, attrs) in acc['attrs'].items():
+        dims=(groupby,)+tuple(dims)
+        s=[stats[g][v] for g in keys]
+        w=np.stack([e['w'] for e in s])
+        nodata=w==0
+        x[v]=(dims, np.where(nodata, np.nan, np.stack([e['mean'] for e in s])), attrs)
+        x[v+'_var']=(dims, np.where(nodata, np.nan, np.stack([e['m2'] for e in s])/np.where(nodata, 1., w)),
+                      dict(attrs, long_name='Variance of ' + attrs.get('long_name', v),
+                           **({'units':'(' + attrs['units'] + ')2'} if 'units' in attrs else {})))
+        x[v+'_min']=(dims, np.stack([e['min'] for e in s]), dict(attrs, long_name='Minimum of ' + attrs.get('long_name', v)))
+        x[v+'_max']=(dims, np.stack([e['max'] for e in s]), dict(attrs, long_name='Maximum of ' + attrs.get('long_name', v)))
+        x[v+'_count']=(dims, np.stack([e['count'] for e in s]), {'long_name':'Number of valid records of ' + v})
+    x.attrs['aggregation']=groupby + ' statistics weighted by the duration of the records (time_counter_bounds)'
+    return x
+
+
+def writeaggregates(acc, prefix, encoding=None):
+    """
+    Write the aggregates of each grouping of ACC in PREFIX + grouping + '.nc' (eg. 'aggregate_month.nc').
+
+    Args:
+        encoding (function): if given, encoding(x, dlist) gives the netcdf encoding of the aggregates (see outputencoding in DiagIO_NEMOPISCES)
+
+    Returns:
+        list of str : written files
+    """
+    files=[]
+    for groupby in acc['groupby']:
+        if not acc['groups'][groupby]:
+            print('No ' + groupby + ' aggregates to write')
+            continue
+        x=aggregates(acc, groupby)
+        f=prefix + groupby + '.nc'
+        dlist=[v for v in x.data_vars if not v.endswith('_count')]
+        x.to_netcdf(f, encoding=None if encoding is None else encoding(x, dlist))
+        print(groupby + ' aggregates written in ' + f)
+        files.append(f)
+    return files
@@ -0,0 +1,152 @@
+import os
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Batch execution of the diagnostics over a series of NEMO-PISCES output files
+
+
+def parsesize(s):
+    """
+    Convert a memory size given as a string (eg. '500M', '16G', '2.5T' or a number of bytes) to bytes.
+    """
+    units={'K':1e3, 'M':1e6, 'G':1e9, 'T':1e12}
+    s=str(s).strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1])*units[s[-1]])
+    return int(float(s))
+
+
+def filesize(files):
+    """
+    Total size on disk (bytes) of the existing files in FILES.
+    """
+    return sum([os.path.getsize(f) for f in files if os.path.isfile(f)])
+
+
+def runbatch(f, jobs, workers=1, maxmemory=None, verbose=False, collect=None):
+    """
+    Run f(**kwargs) for each job, on a pool of processes.
+    Jobs are admitted as long as the sum of their sizes fits in MAXMEMORY. A job larger than MAXMEMORY is run alone.
+    Failures do not stop the batch, they are collected and returned.
+
+    Args:
+        f (function): function to apply (should be importable by the worker processes)
+        jobs (list of tuples (label, kwargs, size)): label to report, arguments of f, and expected memory (bytes) of each job
+        workers (int): number of processes. With 1, jobs run in the current process.
+        maxmemory (int): memory budget (bytes) for the jobs running concurrently. None for no limit.
+        collect (function): if given, collect(value) is called with the value returned by f for each successful job, as soon as it completes,
+                            and the values are not kept (eg. to merge large results on the fly).
+
+    Returns:
+        list of tuples (label, str) : failed jobs and corresponding errors
+        list : values returned by f for the successful jobs (empty with COLLECT)
+    """
+    def completed(value):
+        if collect is None:
+            results.append(value)
+        else:
+            collect(value)
+
+    failures=[]
+    results=[]
+
+    if workers<=1:
+        for label, kwargs, size in jobs:
+            try:
+                completed(f(**kwargs))
+            except Exception as e:
+                if verbose:
+                    traceback.print_exc()
+                print(label + ' failed : ' + repr(e))
+                failures.append((label, repr(e)))
+        return failures, results
+
+    # The scripts are not protected against re-import, hence 'fork' where available.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context=multiprocessing.get_context('fork')
+    else:
+        context=None
+
+    # A worker killed (eg. out of memory) breaks the whole pool, and all its running jobs with it. The pool is then rebuilt,
+    # and these jobs are run again, alone, so that only the job that kills its worker is reported as failed.
+    pending=[(label, kwargs, size, False) for label, kwargs, size in jobs]
+    running={}
+    pool=ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    try:
+        while pending or running:
+            # Admit as many pending jobs as the budget allows
+            while pending and len(running)<workers:
+                label, kwargs, size, alone = pending[0]
+                inuse=sum([r[2] for r in running.values()])
+                if running and (alone or any([r[3] for r in running.values()])):
+                    break
+                if running and maxmemory is not None and inuse+size>maxmemory:
+                    break
+                if maxmemory is not None and size>maxmemory and not alone:
+                    print('Warning : ' + label + ' exceeds the memory budget, it is run alone.')
+                try:
+                    future=pool.submit(f, **kwargs)
+                except BrokenProcessPool:
+                    if running:
+                        # the running jobs are collected below
+                        break
+                    pool.shutdown(wait=True)
+                    pool=ProcessPoolExecutor(max_workers=workers, mp_context=context)
+                    continue
+                pending.pop(0)
+                running[future]=(label, kwargs, size, alone)
+                if verbose:
+                    print('Started ' + label + ' ({0:.1f} MB, {1} running)'.format(size/1e6, len(running)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            dead=[]
+            for future in done:
+                try:
+                    completed(future.result())
+                    running.pop(future)
+                except BrokenProcessPool:
+                    dead.append(running.pop(future))
+                except Exception as e:
+                    label=running.pop(future)[0]
+                    print(label + ' failed : ' + repr(e))
+                    failures.append((label, repr(e)))
+            if not dead:
+                continue
+
+            # The pool is broken : collect the other running jobs, and start a new pool
+            for future in wait(running)[0]:
+                try:
+                    completed(future.result())
+                    running.pop(future)
+                except BrokenProcessPool:
+                    dead.append(running.pop(future))
+                except Exception as e:
+                    label=running.pop(future)[0]
+                    print(label + ' failed : ' + repr(e))
+                    failures.append((label, repr(e)))
+            pool.shutdown(wait=True)
+            pool=ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            for label, kwargs, size, alone in reversed(dead):
+                if alone:
+                    print(label + ' failed : its worker process died (eg. killed when out of memory)')
+                    failures.append((label, 'worker process died (eg. killed when out of memory)'))
+                else:
+                    if verbose:
+                        print(label + ' interrupted by the death of a worker process, it is run again alone')
+                    pending.insert(0, (label, kwargs, size, True))
+    finally:
+        pool.shutdown(wait=True)
+    return failures, results
+
+
+def report(failures, njobs):
+    """
+    Print the summary of a batch.
+    """
+    print('{0}/{1} files completed'.format(njobs-len(failures), njobs))
+    if failures:
+        print('Failed :')
+        for label, e in failures:
+            print('  ' + label + ' : ' + e)
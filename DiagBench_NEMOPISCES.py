@@ -0,0 +1,324 @@
+"""
+    Synthetic NEMO-PISCES outputs and benchmark of the diagnostic catalogue.
+
+    The script generates 'ptrc', 'diad' and 'gridT' files with the variable names, depth bounds and time bounds of NEMO-PISCES outputs,
+    times every entry of the catalogue and the whole diag.py pipeline, and compares the results with a stored baseline.
+
+    Args:
+        grid (str): size of the synthetic grid (see grids)
+        baseline (str): json file of a previous benchmark to compare with
+        save (str): json file where to store the results, eg. as a new baseline
+"""
+# A tool for developers: the benchmark does not need any model output.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+import numpy as np
+from DiagProfile_NEMOPISCES import peakrss
+
+# Synthetic grids : number of levels, y, x
+grids={ 'tiny'    : (10, 20, 30),
+        'small'   : (31, 75, 90),
+        'ORCA2'   : (31, 149, 182),
+        'ORCA1'   : (75, 332, 362),
+        'ORCA025' : (75, 1021, 1442)}
+
+# Content of the synthetic files. Variables of the ptrc files that are not used by the catalogue are included,
+# so that the cost of reading unneeded variables is part of the benchmark.
+ptrcvars=['CHL','PHY','PHY2','ZOO','ZOO2','POC','GOC','NO3','O2','DIC','Alkalini','PO4','Si','Fer','DOC']
+diadvars=['TPP']
+gridTvars=['votemper','vosaline']
+
+
+def depthbounds(nz):
+    """
+    Bounds of NZ levels, from the surface to 5900m, with a first level of 1m and thicker levels at depth, as in ORCA configurations.
+    """
+    return 5900.*(np.arange(nz+1)/nz)**(np.log(5900.)/np.log(nz))
+
+
+def profiles(z, lat, bottom, t):
+    """
+    Synthetic 3D fields for one record.
+
+    Args:
+        z (numpy array): depth of the levels
+        lat (numpy array): latitude (y,x)
+        bottom (numpy array): depth of the ocean floor (y,x), 0 on land
+        t (float): time (days)
+
+    Returns:
+        dict : (deptht,y,x) float32 arrays with NaN below the bottom and on land
+    """
+    Z=z[:,None,None]
+    season=1+0.3*np.sin(2*np.pi*t/365.+np.radians(lat))
+    zmax=40+60*np.abs(np.sin(np.radians(lat)))
+    equator=np.exp(-(lat/15.)**2)
+
+    f={}
+    f['CHL']=season*(0.3*np.exp(-((Z-zmax)/30.)**2)+0.05*np.exp(-Z/50.))
+    f['PHY']=0.6*f['CHL']/1.6
+    f['PHY2']=0.4*f['CHL']/1.6*(1+0.5*np.cos(np.radians(lat)))
+    f['ZOO']=0.3*f['PHY']+0.01*np.exp(-Z/200.)
+    f['ZOO2']=0.2*f['PHY2']+0.005*np.exp(-Z/300.)
+    f['POC']=season*(2*np.exp(-Z/200.)+0.05)
+    f['GOC']=season*(0.5*np.exp(-Z/500.)+0.01)
+    f['NO3']=30/(1+np.exp(-(Z-60-100*(1-equator))/40.))+0.5*(1-equator)
+    f['O2']=250-200*equator*np.exp(-((Z-500.)/250.)**2)
+    f['DIC']=2000+200*(1-np.exp(-Z/1000.))+0*lat
+    f['Alkalini']=2300+50*(1-np.exp(-Z/1000.))+0*lat
+    f['PO4']=f['NO3']/16.
+    f['Si']=100*(1-np.exp(-Z/1500.))+0*lat
+    f['Fer']=0.6*(1-np.exp(-Z/800.))+0*lat
+    f['DOC']=40*np.exp(-Z/300.)+0*lat
+    f['TPP']=5e-6*f['CHL']*np.exp(-Z/50.)*season
+    f['votemper']=2+25*np.exp(-Z/500.)*np.cos(np.radians(lat))
+    f['vosaline']=35+0.5*np.exp(-Z/100.)+0*lat
+
+    wet=Z<bottom
+    rng=np.random.default_rng(int(t))
+    for k in f:
+        f[k]=np.where(wet, f[k]*(1+0.05*rng.standard_normal(f[k].shape)), np.nan).astype(np.float32)
+    return f
+
+
+def makesynthetic(d, grid='tiny', nt=12, tag='1m_20000101_20001231', t0=None):
+    """
+    Write a triplet of synthetic 'ptrc', 'diad' and 'gridT' files in the directory D.
+    Files are written record by record, so that large grids (eg. ORCA025) can be generated with little memory.
+
+    Args:
+        d (str): directory
+        grid (str or tuple): a key of grids, or (levels, y, x)
+        nt (int): number of records (monthly)
+        tag (str): tag in the file names (ORCA_<tag>_ptrc_T.nc, ...)
+        t0 (float): time of the first record (days since 1900-01-01). Default: the start date of the tag (eg. 2000-01-01).
+
+    Returns:
+        list of str : 'ptrc', 'diad' and 'gridT' files
+    """
+    import netCDF4
+
+    if t0 is None:
+        start=tag.split('_')[1]
+        t0=float((np.datetime64(start[:4]+'-'+start[4:6]+'-'+start[6:8])-np.datetime64('1900-01-01')).astype('timedelta64[D]').astype(int))
+    nz, ny, nx = grids[grid] if isinstance(grid, str) else grid
+    bnds=depthbounds(nz)
+    z=0.5*(bnds[1:]+bnds[:-1])
+    lon, lat = np.meshgrid(np.linspace(-180,180,nx,endpoint=False), np.linspace(-80,90,ny))
+    # two continents and a sloping sea floor
+    land=((np.abs(lon+60)<20)&(np.abs(lat)<60)) | ((np.abs(lon-30)<15)&(lat>-35)&(lat<35))
+    bottom=np.where(land, 0., 200+5000*np.abs(np.sin(np.radians(lon)))**0.5*np.cos(np.radians(lat)))
+
+    os.makedirs(d, exist_ok=True)
+    files=[]
+    for ftype, vlist in [('ptrc_T', ptrcvars), ('diad_T', diadvars), ('gridT_T', gridTvars)]:
+        f=os.path.join(d, 'ORCA_' + tag + '_' + ftype + '.nc')
+        with netCDF4.Dataset(f, 'w') as nc:
+            nc.createDimension('axis_nbounds', 2)
+            nc.createDimension('x', nx)
+            nc.createDimension('y', ny)
+            nc.createDimension('deptht', nz)
+            nc.createDimension('time_counter', None)
+
+            for v, data in [('nav_lon', lon), ('nav_lat', lat)]:
+                ncv=nc.createVariable(v, 'f4', ('y','x'))
+                ncv[:]=data
+            ncv=nc.createVariable('deptht', 'f4', ('deptht',))
+            ncv.setncatts({'units':'m', 'positive':'down', 'bounds':'deptht_bounds'})
+            ncv[:]=z
+            ncv=nc.createVariable('deptht_bounds', 'f4', ('deptht','axis_nbounds'))
+            ncv[:]=np.stack([bnds[:-1], bnds[1:]], axis=1)
+            for v in ['time_centered', 'time_counter']:
+                ncv=nc.createVariable(v, 'f8', ('time_counter',))
+                ncv.setncatts({'units':'seconds since 1900-01-01 00:00:00', 'calendar':'gregorian', 'bounds':v+'_bounds'})
+                nc.createVariable(v+'_bounds', 'f8', ('time_counter','axis_nbounds'))
+
+            for v in vlist:
+                ncv=nc.createVariable(v, 'f4', ('time_counter','deptht','y','x'), fill_value=np.float32(1e20))
+                ncv.setncatts({'online_operation':'average', 'coordinates':'nav_lat nav_lon'})
+
+            for n in range(nt):
+                t=t0+30.*n
+                for v in ['time_centered', 'time_counter']:
+                    nc.variables[v][n]=(t+15.)*86400.
+                    nc.variables[v+'_bounds'][n,:]=[t*86400., (t+30.)*86400.]
+                fields=profiles(z, lat, bottom, t)
+                for v in vlist:
+                    nc.variables[v][n]=fields[v]
+        files.append(f)
+    return files
+
+
+def benchdiags(files, keys, repeat=1):
+    """
+    Time every catalogue entry of KEYS, computed alone (with its requirements) on the loaded triplet FILES.
+    Memory is the peak of the numpy allocations during the computation (tracemalloc).
+
+    Returns:
+        dict : {'time' (s), 'memory' (bytes)} of each entry
+    """
+    import DiagFunctions_NEMOPISCES as diag
+    import DiagIO_NEMOPISCES as dio
+
+    x=dio.loadfiles(*files)
+    results={}
+    for key in keys:
+        times=[]
+        tracemalloc.start()
+        for r in range(repeat):
+            xk=x.copy()
+            tic=time.perf_counter()
+            diag.add2D(xk, key, verbose=False)
+            times.append(time.perf_counter()-tic)
+            del xk
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[key]={'time':min(times), 'memory':peak}
+    return results
+
+
+def _pipeline(argv, queue):
+    # Run diag.py within this (fresh) process. A result (or an error) is always put on the queue.
+    import runpy
+    sys.argv=['diag.py']+argv
+    tic=time.perf_counter()
+    error=None
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'diag.py'), run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error='diag.py exited with status {0}'.format(e.code)
+    except BaseException as e:
+        error=repr(e)
+    finally:
+        queue.put({'time':time.perf_counter()-tic, 'memory':peakrss(), 'error':error})
+
+
+def benchpipeline(d, argv, repeat=1):
+    """
+    Time the whole diag.py pipeline on the directory D, with the extra arguments ARGV.
+    Each run takes place in a new process, whose peak resident memory is reported.
+
+    Returns:
+        dict : {'time' (s), 'memory' (bytes)}, or {'error' (str)} if a run failed
+    """
+    import queue as queues
+    context=multiprocessing.get_context('spawn')
+    runs=[]
+    for r in range(repeat):
+        queue=context.Queue()
+        p=context.Process(target=_pipeline, args=(['--dir', d]+argv, queue))
+        p.start()
+        run=None
+        while run is None:
+            try:
+                run=queue.get(timeout=1)
+            except queues.Empty:
+                if not p.is_alive():
+                    # died without a result (eg. killed)
+                    run={'error':'diag.py process died with exit code {0}'.format(p.exitcode)}
+        p.join()
+        if run.get('error') is not None:
+            return {'error':run['error']}
+        runs.append(run)
+    return {'time':min([r['time'] for r in runs]), 'memory':min([r['memory'] for r in runs])}
+
+
+def compare(results, baseline, tolerance=0.2, mintime=0.01):
+    """
+    Compare RESULTS with a BASELINE of the same grid.
+
+    Returns:
+        list of str : regressions, ie. times or memories exceeding the baseline by more than TOLERANCE (relative).
+                      Time differences below MINTIME (s) are considered as noise.
+    """
+    regressions=[]
+    for name, r in results.items():
+        b=baseline.get(name)
+        if b is None:
+            continue
+        for m in ['time','memory']:
+            if m=='time' and r[m]-b[m]<mintime:
+                continue
+            if b[m]>0 and r[m]>b[m]*(1+tolerance):
+                regressions.append('{0:<25} {1:<6} : {2:.4g} vs {3:.4g} (+{4:.0f}%)'.format(name, m, r[m], b[m], 100*(r[m]/b[m]-1)))
+    return regressions
+
+
+if __name__=='__main__':
+    import DiagFunctions_NEMOPISCES as diag
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-g','--grid', type=str, default='tiny', choices=list(grids.keys()), help='Size of the synthetic grid')
+    parser.add_argument('-t','--nt', type=int, default=12, help='Number of records per file')
+    parser.add_argument('-n','--nfiles', type=int, default=2, help='Number of file triplets for the pipeline benchmark')
+    parser.add_argument('-d','--dir', type=str, default=None, help='Directory of the synthetic files (default: temporary directory). Existing files are reused.')
+    parser.add_argument('-r','--repeat', type=int, default=3, help='Number of repetitions (the fastest is kept)')
+    parser.add_argument('-l','--diaglist', nargs='+', default=[k for k in diag.ddiag2D if k!='VOID'], help='Catalogue entries to time')
+    parser.add_argument('--pipeline', nargs='+', default=['', '--lazy', '--block 1'],
+     help='diag.py options of the pipeline runs (one string per run, "" for the default run)')
+    parser.add_argument('-b','--baseline', type=str, default=None, help='json file of a previous benchmark to compare with')
+    parser.add_argument('-s','--save', type=str, default=None, help='json file where to store the results')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative increase reported as regression')
+    parser.add_argument('--generate-only', help='Only generate the synthetic files', action='store_true')
+    args = parser.parse_args()
+
+    d=args.dir if args.dir is not None else tempfile.mkdtemp(prefix='diagbench_')
+    d=os.path.join(d, '')
+    for i in range(args.nfiles):
+        tag='1m_{0:04d}0101_{0:04d}1231'.format(2000+i)
+        if not os.path.isfile(os.path.join(d, 'ORCA_' + tag + '_ptrc_T.nc')):
+            print('Generating ' + args.grid + ' files ' + tag + ' in ' + d)
+            makesynthetic(d, grid=args.grid, nt=args.nt, tag=tag)
+    if args.generate_only:
+        sys.exit()
+
+    tag='1m_20000101_20001231'
+    files=[os.path.join(d, 'ORCA_' + tag + '_' + f + '.nc') for f in ['ptrc_T','diad_T','gridT_T']]
+
+    results={}
+    for key, r in benchdiags(files, args.diaglist, repeat=args.repeat).items():
+        results['diag:'+key]=r
+    failed={}
+    for opts in args.pipeline:
+        r=benchpipeline(d, opts.split()+['-l']+args.diaglist, repeat=args.repeat)
+        if 'error' in r:
+            failed['pipeline:'+(opts or 'default')]=r['error']
+        else:
+            results['pipeline:'+(opts or 'default')]=r
+        for f in os.listdir(d):
+            if '_diag_' in f:
+                os.remove(os.path.join(d, f))
+
+    print('\nBenchmark on grid ' + args.grid + ' {0} x {1} x {2}, {3} records'.format(*grids[args.grid], args.nt))
+    for name, r in results.items():
+        print('{0:<25} {1:>10.4f} s {2:>10.1f} MB'.format(name, r['time'], r['memory']/1e6))
+    for name, e in failed.items():
+        print('{0:<25} failed : {1}'.format(name, e))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'grid':args.grid, 'nt':args.nt, 'results':results}, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+        if baseline['grid']!=args.grid or baseline['nt']!=args.nt:
+            print('Baseline obtained on another grid (' + baseline['grid'] + '), not compared')
+            sys.exit(1 if failed else 0)
+        regressions=compare(results, baseline['results'], tolerance=args.tolerance)
+        if regressions:
+            print('\nRegressions with respect to ' + args.baseline + ' :')
+            for r in regressions:
+                print('  ' + r)
+            sys.exit(1)
+        print('\nNo regression with respect to ' + args.baseline)
+    if failed:
+        sys.exit(1)
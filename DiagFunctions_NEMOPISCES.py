@@ -1,9 +1,21 @@
+import ast
 from numpy import append
-import xarray as xr
-import xgcm
+import numpy as np
+from DiagProfile_NEMOPISCES import timed
 
 # Catalogue of diagnostics for PISCES outputs
 # A. Capet - acapet@uliege.be - Feb 2022
+#
+# 'req'  : required variables or catalogue entries
+# 'f'    : function computing the diagnostic from the (completed) xarray
+# 'expr' : (optional) pointwise expression of the diagnostic (see evalexpr), evaluated in one pass without full-size temporaries.
+#          'f' then serves as reference. Entries can also be declared in an external YAML catalogue (see loadcatalogue).
+# 'vred' : (optional) vertical reductions ('integrate', 'average', 'extent') combined by 'vcombine' (default: the first one).
+#          Entries with 'vred' are evaluated together by vreduce, in one pass per variable. 'f' then serves as reference.
+# 'zwin' : (optional) [upper, lower] depth window (m) outside of which the diagnostic does not look (None for no limit).
+#          Equal bounds denote a diagnostic at a given depth. Only the corresponding levels are read (see zlevels).
+#
+# xarray and xgcm are imported in the functions that use them, so that the catalogue can be read without them (eg. diag.py --printlist).
 
 ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] , 
                             'attrs' : {'units'     : 'mmol C m-3', 
@@ -13,6 +25,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat deptht'},
                             'desc' : 'Total (dead) organic matter carbon content',
+                            'expr' : 'POC + GOC',
                             'f' : lambda x : (x.POC + x.GOC)},
             'TrophicEfficiency'    :  { 'req' : ['ZOO','ZOO2','PHY','PHY2'] , 
                             'attrs' : {'units'     : '-', 
@@ -22,6 +35,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat deptht'},
                             'desc' : 'Ratio ZOO/PHYTO',
+                            'expr' : '(ZOO2 + ZOO)/(PHY + PHY2)',
                             'f' : lambda x : (x.ZOO2 + x.ZOO)/(x.PHY + x.PHY2)},
             'TrophicEfficiencyI'    :  { 'req' : ['deptht','ZOO','ZOO2','PHY','PHY2'] , 
                             'attrs' : {'units'     : '-', 
@@ -33,6 +47,10 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                             'desc' : 'Ratio Int_{z=0-200}(TotZoo)/Int_{z=0-200}(TotPhyto)',
                             # AC 22032022 - replace lower deptht bounds from negative to positive values. 
                             # TODO : implement consistency check with deptht convention
+                            'zwin' : [None, 200],
+                            'vred' : [{'op':'integrate', 'v':'ZOO', 'lower':200}, {'op':'integrate', 'v':'ZOO2', 'lower':200},
+                                      {'op':'integrate', 'v':'PHY', 'lower':200}, {'op':'integrate', 'v':'PHY2', 'lower':200}],
+                            'vcombine' : lambda r : (r[0]+r[1])/(r[2]+r[3]),
                             'f' : lambda x : (integratevar(x,'ZOO', lower=200)+ integratevar(x,'ZOO2', lower=200))/(integratevar(x,'PHY', lower=200)+ integratevar(x,'PHY2', lower=200))},
             'ratioLargeM'    :  { 'req' : ['ratioLarge'] , 
                             'attrs' : {'units'     : '-', 
@@ -42,6 +60,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Average ( DIA/PHYTO ) where TotPhyto>0.01',
+                            'vred' : [{'op':'average', 'v':'ratioLarge', 'where':lambda x : (x.PHY2+x.PHY)>0.01}],
                             'f' : lambda x : averagevar(x,'ratioLarge', conditions=(x.PHY2+x.PHY)>0.01)},                            
             'pocM200'    :  { 'req' : ['poc'] , 
                             'attrs' : {'units'     : 'mmol C m-3', 
@@ -51,6 +70,8 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Average poc content, 0-200m',
+                            'zwin' : [None, 200],
+                            'vred' : [{'op':'average', 'v':'poc', 'lower':200}],
                             'f' : lambda x : averagevar(x,'poc', lower=200)},                            
             'CHLM5'    :  { 'req' : ['CHL'] , 
                             'attrs' : {'units'     : 'mg Chl m-3', 
@@ -60,6 +81,8 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Average chl content, 0-5m',
+                            'zwin' : [None, 5],
+                            'vred' : [{'op':'average', 'v':'CHL', 'lower':5}],
                             'f' : lambda x : averagevar(x,'CHL', lower=5)},                            
             'ratioLarge'    :  { 'req' : ['PHY','PHY2'] , 
                             'attrs' : {'units'     : '-', 
@@ -69,6 +92,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat deptht'},
                             'desc' : 'DIA/PHYTO',
+                            'expr' : 'PHY2/(PHY2+PHY)',
                             'f' : lambda x : x.PHY2/(x.PHY2+x.PHY)},                            
             'pocF'    :  { 'req' : ['POC','GOC'] , 
                             'attrs' : {'units'     : 'mg C m-2 d-1', 
@@ -76,8 +100,9 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'valid_min' : -1e20,
                                         'valid_max' : 1e20,
                                         'cell_methods' : 'time: mean',
-                                        'coordinates': 'lon lat deptt'},
+                                        'coordinates': 'lon lat deptht'},
                             'desc' : 'Downward Flux of Particulate Organic Carbon ! ASSUMED VALUES FOR SINKING VELOCITIES : 2 and 50 m/d !',
+                            'expr' : '12*(POC*2 + GOC*50)',
                             'f' : lambda x : 12*(x.POC*2 + x.GOC*50)},  # TODO : enable parameter read in fabm.yaml
             'pocF100'    :  { 'req' : ['pocF','deptht'] , 
                             'attrs' : {'units'     : 'mg C m-2 d-1', 
@@ -87,6 +112,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Downward Flux of Particulate Organic Carbon interpolated @ 100m',
+                            'zwin' : [100, 100],
                             'f' : lambda x : x.pocF.interp(deptht=100)}, 
             'zchlmax'    :  { 'req' : ['CHL','deptht'] , 
                             'attrs' : {'units'     : 'm', 
@@ -132,6 +158,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Net Primary Production - vertically integrated',
+                            'vred' : [{'op':'integrate', 'v':'TPP'}],
                             'f' : lambda x : integratevar(x,'TPP')},
             'CHLI'    :  { 'req' : ['CHL','deptht'] , 
                             'attrs' : {'units'     : 'mg Chl m-2', 
@@ -141,6 +168,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Chlorophyll - vertically integrated',
+                            'vred' : [{'op':'integrate', 'v':'CHL'}],
                             'f' : lambda x : integratevar(x,'CHL')},
             'OMZextent'    :  { 'req' : ['O2','deptht'] , 
                             'attrs' : {'units'     : 'm', 
@@ -150,6 +178,7 @@ ddiag2D = { 'poc'    :  { 'req' : ['POC','GOC'] ,
                                         'cell_methods' : 'time: mean',
                                         'coordinates': 'lon lat'},
                             'desc' : 'Vertical extent where oxygen <90µM',
+                            'vred' : [{'op':'extent', 'v':'O2', 'condition':'lower', 'value':120}],
                             'f' : lambda x : extentwhere(x,'O2','lower',120)},            # 'CHLsurf'    :  { 'req' : ['total_chlorophyll_calculator_result_'] , 
             #                 'attrs' : {'units'     : 'mg C m-3', 
             #                             'long_name' : 'Surface Chlorophyll', 
@@ -187,13 +216,201 @@ r2.dom_c.data=r2.dom_c.data*1e6
 r2.dom_c.attrs["units"] = 'mmol C m-3'
 '''
 
-def add2D(x,keys, verbose=True):
+def is3D(key):
+    """
+    True if the catalogue entry KEY (or the raw model variable KEY) has a vertical dimension.
+    Raw model variables are assumed to be 3D tracers, except the deptht coordinate itself.
+    """
+    if key in ddiag2D:
+        return 'deptht' in ddiag2D[key]['attrs']['coordinates'].split()
+    return key!='deptht'
+
+
+def plan2D(keys, present=()):
+    """
+    Build the execution plan of the diagnostics KEYS from the dependency graph of the catalogue.
+    Each catalogue entry appears once, after all its requirements (topological order).
+
+    Args:
+        keys (string or vector of strings): identifiers of the requested diagnostics.
+        present (list of str): variables already available, that need not be computed.
+
+    Returns:
+        list of tuples (key, drop) : catalogue entries in execution order, with the intermediate entries that are not used anymore once KEY is computed.
+    """
+    if isinstance(keys,str):
+        keys=[keys]
+
+    order=[]
+    def visit(k, path):
+        if k in order or k in present:
+            return
+        if k in path:
+            raise ValueError('Circular dependency in the catalogue : ' + ' -> '.join(path+[k]))
+        for d in ddiag2D[k]['req']:
+            if d in ddiag2D:
+                visit(d, path+[k])
+        order.append(k)
+
+    for key in keys:
+        visit(key, [])
+
+    # Last consumer of each intermediate entry
+    last={}
+    for i, k in enumerate(order):
+        for d in ddiag2D[k]['req']:
+            if d in order and d not in keys:
+                last[d]=i
+
+    return [ (k, [d for d in last if last[d]==i]) for i, k in enumerate(order) ]
+
+
+def execplan(keys, z=None, present=(), fused=True, window=True):
     """
-    Add the diagnostic KEY to the input xarray x
+    Steps of add2D for the diagnostics KEYS, in execution order.
+    Entries with a depth window ('zwin') are computed first, by groups of the same window, on the corresponding levels only
+    (see zlevels). The other entries follow the plan of plan2D, the vertical reductions that can be computed at the same stage
+    being evaluated together (see vreduce).
+
+    Args:
+        keys (string or vector of strings): identifiers of the requested diagnostics.
+        z (numpy array): depth of the levels (deptht), to select the levels of the depth windows. None for all levels.
+        present (list of str): variables already available, that need not be computed.
+        fused, window : see add2D
+
+    Returns:
+        list of dict : 'keys' computed at each step, 'op' ('vred', 'expr' or 'f'), 'zwin' and 'levels' (slice of deptht, or None)
+                       of the depth window, 'wkeys', the requested entries of this window (kept at its end), and 'drop',
+                       the intermediate entries freed after the step.
+    """
+    if isinstance(keys,str):
+        keys=[keys]
+    present=list(present)
+    keys=[k for k in keys if k not in present]
+    steps=[]
+
+    if window:
+        wins={}
+        for key in keys:
+            if ddiag2D[key].get('zwin') is not None:
+                wins.setdefault(tuple(ddiag2D[key]['zwin']), []).append(key)
+        for zwin, ks in wins.items():
+            # the group is computed on a subset with the requirements of KS only
+            need=requiredvars(ks)+[k for k, _ in plan2D(ks)]
+            for step in execplan(ks, present=[p for p in present if p in need], fused=fused, window=False):
+                step.update(zwin=zwin, levels=None if z is None else zlevels(z, zwin), wkeys=list(ks))
+                steps.append(step)
+            present+=ks
+        keys=[k for k in keys if k not in present]
+
+    plan=plan2D(keys, present=present)
+    done=list(present)
+    available=lambda d : d in done or d not in ddiag2D
+    for i, (key, drop) in enumerate(plan):
+        if key in done:
+            # already computed in a batch of vertical reductions
+            if steps:
+                steps[-1]['drop']+=drop
+            continue
+        if fused and 'vred' in ddiag2D[key]:
+            # all vertical reductions that can be computed at this stage
+            batch=[k for k, _ in plan[i:] if 'vred' in ddiag2D[k] and k not in done
+                                           and all([available(d) for d in ddiag2D[k]['req']])]
+            steps.append({'keys':batch, 'op':'vred', 'zwin':None, 'levels':None, 'wkeys':[], 'drop':list(drop)})
+            done+=batch
+        else:
+            op='expr' if fused and 'expr' in ddiag2D[key] else 'f'
+            steps.append({'keys':[key], 'op':op, 'zwin':None, 'levels':None, 'wkeys':[], 'drop':list(drop)})
+            done.append(key)
+    return steps
+
+
+def planmemory(keys, sizes, present=(), itemsize=8, z=None):
+    """
+    Estimate the memory needed to run the steps of add2D for KEYS (see execplan) on a grid of the given SIZES.
+    The estimate counts the raw variables (as loaded with --lazy), the live catalogue entries (on the levels of their depth window, if any),
+    and one 3D temporary for each computation (none for the expressions, see evalexpr).
+
+    Args:
+        keys (string or vector of strings): identifiers of the requested diagnostics.
+        sizes (dict): length of the 'time_counter', 'deptht', 'y' and 'x' dimensions.
+        itemsize (int): bytes per value (8 for float64).
+        z (numpy array): depth of the levels, to size the depth windows (see execplan). Without it, windows span all levels.
+
+    Returns:
+        int, list of tuples : estimated peak memory (bytes), and the steps of execplan with the memory after each of them
+    """
+    if isinstance(keys,str):
+        keys=[keys]
+    n2D=itemsize*sizes.get('time_counter',1)*sizes.get('y',1)*sizes.get('x',1)
+    nz=sizes.get('deptht',1)
+    nlev=lambda step : nz if step['levels'] is None else len(range(*step['levels'].indices(nz)))
+    nbytes=lambda k, nl : n2D*nl if is3D(k) else n2D
+
+    raw=sum([nbytes(v, nz) for v in requiredvars(keys) if v not in present])
+    steps=execplan(keys, z=z, present=present)
+    live={}
+    peak=raw
+    out=[]
+    for i, step in enumerate(steps):
+        nl=nlev(step)
+        for k in step['keys']:
+            live[k]=nbytes(k, nl)
+        peak=max(peak, raw+sum(live.values())+(0 if step['op']=='expr' else n2D*nl))
+        for d in step['drop']:
+            live.pop(d, None)
+        if step['zwin'] is not None and (i+1==len(steps) or steps[i+1]['zwin']!=step['zwin']):
+            # end of a depth window : only the entries requested with this window are kept
+            for s in steps[:i+1]:
+                if s['zwin']==step['zwin']:
+                    for k in s['keys']:
+                        if k not in step['wkeys']:
+                            live.pop(k, None)
+        out.append((step, raw+sum(live.values())))
+    return peak, out
+
+
+def zlevels(z, zwin):
+    """
+    Levels needed by a diagnostic with depth window ZWIN.
+
+    Args:
+        z (numpy array): depth of the levels (deptht)
+        zwin (list): [upper, lower] depth window. With upper==lower, the two levels bracketing this depth are selected.
+
+    Returns:
+        slice : range of levels along deptht
+    """
+    upper, lower = zwin
+    if upper is not None and upper==lower:
+        k=int(np.searchsorted(z, upper))
+        k=min(max(k-1,0), len(z)-2)
+        return slice(k, k+2)
+
+    m=np.ones(z.shape, dtype=bool)
+    if lower is not None:
+        m&=z<lower
+    if upper is not None:
+        m&=z>upper
+    k=np.flatnonzero(m)
+    if len(k)==0:
+        return slice(0,0)
+    return slice(int(k[0]), int(k[-1])+1)
+
+
+def add2D(x,keys, verbose=True, free=False, fused=True, window=True, profile=None, dtype=None):
+    """
+    Add the diagnostic KEY to the input xarray x, following the steps of execplan.
 
     Args:
         x (xarray): xarray containing model outputs
         keys (string or vector of strings): identifier of the diagnostic. There should be a corresponding entry in the diagnsotic dictionnary. 
+        free (bool): if True, intermediate diagnostics (eg. 'poc', 'pocF') are removed from x as soon as they are not needed anymore.
+        fused (bool): if True, the entries with vertical reductions ('vred') are evaluated together with vreduce, and the entries with
+                      an expression ('expr') with evalexpr. Otherwise their 'f' function is used.
+        window (bool): if True, the entries with a depth window ('zwin') are computed on the corresponding levels only.
+        profile (dict): if given, the wall time of each diagnostic is added to profile['diags'] (see DiagProfile_NEMOPISCES)
+        dtype (str): if given (eg. 'float32'), expressions are computed with this type (see evalexpr)
 
     Returns:
         xarray : xarray completed with the the diagnostic key
@@ -201,18 +418,155 @@ def add2D(x,keys, verbose=True):
     if type(keys) is not list:
         keys=[keys]
 
-    for key in keys:
-        # Test depedencies
-        for d in ddiag2D[key]['req']:
-            if d in x.keys():
-                continue
+    window=window and 'deptht' in x.variables
+    steps=execplan(keys, z=x['deptht'].values if window else None, present=list(x.keys()), fused=fused, window=window)
+    i=0
+    while i<len(steps):
+        zwin=steps[i]['zwin']
+        if zwin is None:
+            _runstep(x, steps[i], keys, verbose, free, profile, dtype)
+            i+=1
+            continue
+        # Diagnostics with a depth window are computed on the corresponding levels only
+        group=[]
+        while i<len(steps) and steps[i]['zwin']==zwin:
+            group.append(steps[i])
+            i+=1
+        ks=group[0]['wkeys']
+        levels=group[0]['levels']
+        if verbose:print ('levels {0}-{1} for '.format(levels.start, levels.stop-1) + ', '.join(ks))
+        need=requiredvars(ks)+[k for k, _ in plan2D(ks)]+['h']
+        with timed(profile, 'zwin'):
+            xs=x[[v for v in x.data_vars if v in need]].isel(deptht=levels)
+        for step in group:
+            _runstep(xs, step, ks, verbose, True, profile, dtype)
+        for k in ks:
+            x[k]=xs[k]
+        del xs
+    return x
+
+
+def _runstep(x, step, keys, verbose, free, profile, dtype):
+    # Run one step of execplan on X (see add2D)
+    if step['op']=='vred':
+        with timed(profile, '+'.join(step['keys']), 'diags'):
+            res=vreduce(x, step['keys'])
+        for k, v in res.items():
+            x[k]  = v
+            x[k].attrs=ddiag2D[k]['attrs']
+            if verbose:print ('just added '+  k +' :' + ddiag2D[k]['desc'])
+    else:
+        key=step['keys'][0]
+        if verbose and key not in keys:
+            print( 'Lacking ' + key + ' to compute '+ ', '.join([k for k in keys if key in [e for e, _ in plan2D(k)]]))
+        with timed(profile, key, 'diags'):
+            if step['op']=='expr':
+                x[key]  = evalexpr(x, ddiag2D[key]['expr'], dtype=dtype)
             else:
-                if verbose:print( 'Lacking ' + d + ' to compute '+ key)
-                x= add2D(x,d, verbose=verbose)
-        x[key]  = ddiag2D[key]['f'](x) 
+                x[key]  = ddiag2D[key]['f'](x)
         x[key].attrs=ddiag2D[key]['attrs']
         if verbose:print ('just added '+  key +' :' + ddiag2D[key]['desc'])
-    return x
+    if free:
+        for d in step['drop']:
+            del x[d]
+            if verbose:print ('freed '+  d)
+
+
+def wetcolumns(x, v=None):
+    """
+    Index of the ocean columns of the grid, from the fill values (NaN) of a 3D variable at the surface, for the first record.
+    The first land column, if any, is appended to the index: diagnostics computed on it give the value of all land columns.
+
+    Args:
+        x (xarray): xarray containing model outputs
+        v (str): variable defining the mask (default: the first variable with deptht, y and x dimensions)
+
+    Returns:
+        dict : 'iy' and 'ix' indices of the packed columns, 'wet' mask (y,x), and 'land' (True if the last packed column is land)
+    """
+    if v is None:
+        v=[k for k in x.data_vars if {'deptht','y','x'}<=set(x[k].dims)][0]
+    m=x[v]
+    if 'time_counter' in m.dims:
+        m=m.isel(time_counter=0)
+    wet=m.isel(deptht=0).notnull().transpose('y','x').values
+    iy, ix = np.nonzero(wet)
+    land=not wet.all()
+    if land:
+        ly, lx = np.argwhere(~wet)[0]
+        iy=np.append(iy, ly)
+        ix=np.append(ix, lx)
+    return {'iy':iy, 'ix':ix, 'wet':wet, 'land':land}
+
+
+def compact(x, cols):
+    """
+    Pack the columns COLS (see wetcolumns) of all the variables of X along a single 'wet' dimension, replacing y and x.
+    """
+    import xarray as xr
+    return x.isel(y=xr.DataArray(cols['iy'], dims='wet'), x=xr.DataArray(cols['ix'], dims='wet'))
+
+
+def expand(x, cols, ref):
+    """
+    Scatter the packed diagnostics of X back on the horizontal grid.
+    Land columns take the value computed on the packed land column, or NaN.
+
+    Args:
+        x (xarray): diagnostics with a 'wet' dimension (see compact)
+        cols (dict): packed columns (see wetcolumns)
+        ref (xarray): dataset providing the horizontal coordinates (nav_lon, nav_lat)
+
+    Returns:
+        xarray : diagnostics on (..., y, x)
+    """
+    import xarray as xr
+    ny, nx = cols['wet'].shape
+    nw=int(cols['wet'].sum())
+    out=xr.Dataset(coords={c : ref[c] for c in ref.coords if set(ref[c].dims)<={'y','x'} and ref[c].dims})
+    for v in x.data_vars:
+        da=x[v]
+        if 'wet' not in da.dims:
+            out[v]=da
+            continue
+        da=da.transpose(..., 'wet')
+        vals=np.asarray(da.values)
+        if vals.dtype.kind!='f':
+            vals=vals.astype(float)
+        full=np.empty(vals.shape[:-1]+(ny, nx), dtype=vals.dtype)
+        full[...]=vals[..., -1:, None] if cols['land'] else np.nan
+        full[..., cols['iy'][:nw], cols['ix'][:nw]]=vals[..., :nw]
+        out[v]=(da.dims[:-1]+('y','x'), full, da.attrs)
+        out[v].encoding=da.encoding
+        for c in da.coords:
+            if 'wet' not in da[c].dims:
+                out.coords[c]=da[c]
+    return out
+
+
+def requiredvars(keys):
+    """
+    List the raw model variables needed to compute the diagnostics KEYS.
+    The 'req' entries of the catalogue are walked recursively, so that intermediate diagnostics (eg. 'poc', 'pocF') are replaced by their own requirements.
+
+    Args:
+        keys (string or vector of strings): identifiers of the diagnostics.
+
+    Returns:
+        list of str : names of the variables to be read from the model outputs (catalogue entries excluded)
+    """
+    if isinstance(keys,str):
+        keys=[keys]
+
+    raw=[]
+    for key in keys:
+        for d in ddiag2D[key]['req']:
+            if d in ddiag2D:
+                new=requiredvars(d)
+            else:
+                new=[d]
+            raw+=[n for n in new if n not in raw]
+    return raw
 
 
 def integratevar(x,v,upper=None, lower=None):
@@ -240,8 +594,8 @@ def extentwhere(x,v,condition, value):
             metrics = {('Z',):['h']})
 
     if condition=='lower':
-        x['cond']=x[v]<value
-        return  grid.integrate(x['cond'],'Z')
+        cond=x[v]<value
+        return  grid.integrate(cond,'Z')
     else:
         print('condition unknwon') 
 
@@ -276,6 +630,271 @@ def derivate(x,v,upper=None, lower=None):
 
     return  grid.derivative(xouter,'Z', boundary='extend')
 
+def vweights(x, reds):
+    """
+    Layer-thickness weights of the vertical reductions REDS, ie. the cell height h masked outside the depth window of each reduction.
+    Computed once for all reductions of a file.
+
+    Args:
+        x (xarray): xarray containing model outputs and the cell height 'h'
+        reds (list of dict): vertical reductions, with optional 'upper' and 'lower' depth bounds
+
+    Returns:
+        list of numpy arrays : weights along deptht for each reduction
+    """
+    h=x['h'].values
+    z=x['deptht'].values
+    ws=[]
+    for r in reds:
+        m=np.ones(z.shape, dtype=bool)
+        if r.get('lower') is not None:
+            m&=z<r['lower']
+        if r.get('upper') is not None:
+            m&=z>r['upper']
+        ws.append(np.where(m, h, 0.))
+    return ws
+
+
+def vreduce(x, keys):
+    """
+    Evaluate the vertical reductions ('vred') of the catalogue entries KEYS together.
+    Reductions sharing the same variable (and condition) are computed with a single weighted sum over deptht, for all depth windows at once.
+    Results are the same as those of integratevar, averagevar and extentwhere.
+
+    Args:
+        x (xarray): xarray containing model outputs and the cell height 'h'
+        keys (list of str): catalogue entries with a 'vred' field
+
+    Returns:
+        dict : DataArray of each diagnostic
+    """
+    import xarray as xr
+    reds=[r for k in keys for r in ddiag2D[k]['vred']]
+    ws=vweights(x, reds)
+
+    # Group the reductions by source array
+    groups={}
+    for i, r in enumerate(reds):
+        if r['op']=='extent':
+            g=('extent', r['v'], r['condition'], r['value'])
+        else:
+            g=('value', r['v'], r.get('where'))
+        groups.setdefault(g, []).append(i)
+
+    out=[None]*len(reds)
+    for g, idx in groups.items():
+        W=xr.DataArray(np.stack([ws[i] for i in idx], axis=1), dims=('deptht','vred'))
+        X=x[g[1]]
+        if g[0]=='extent':
+            if g[2]=='lower':
+                S=xr.dot(X<g[3], W, dim='deptht')
+            else:
+                print('condition unknwon')
+                S=None
+        else:
+            if g[2] is not None:
+                X=X.where(g[2](x))
+            S=xr.dot(X.fillna(0), W, dim='deptht')
+            if any([reds[i]['op']=='average' for i in idx]):
+                N=xr.dot(X.notnull(), W, dim='deptht')
+        for j, i in enumerate(idx):
+            if S is None:
+                continue
+            if reds[i]['op']=='average':
+                sw=N.isel(vred=j)
+                out[i]=S.isel(vred=j).where(sw!=0)/sw.where(sw!=0)
+            else:
+                out[i]=S.isel(vred=j)
+
+    res={}
+    n=0
+    for k in keys:
+        r=out[n:n+len(ddiag2D[k]['vred'])]
+        n+=len(ddiag2D[k]['vred'])
+        res[k]=ddiag2D[k].get('vcombine', lambda r : r[0])(r)
+    return res
+
+
+# Operators and functions allowed in the expressions of the catalogue
+_binops={ast.Add : np.add, ast.Sub : np.subtract, ast.Mult : np.multiply, ast.Div : np.true_divide, ast.Pow : np.power,
+         ast.BitAnd : np.logical_and, ast.BitOr : np.logical_or}
+_cmpops={ast.Lt : np.less, ast.LtE : np.less_equal, ast.Gt : np.greater, ast.GtE : np.greater_equal,
+         ast.Eq : np.equal, ast.NotEq : np.not_equal}
+_unops={ast.USub : np.negative, ast.UAdd : np.positive, ast.Invert : np.logical_not}
+_funcs={'abs' : np.abs, 'sqrt' : np.sqrt, 'exp' : np.exp, 'log' : np.log, 'log10' : np.log10,
+        'minimum' : np.minimum, 'maximum' : np.maximum, 'where' : np.where}
+_compiled={}
+
+
+def compileexpr(expr):
+    """
+    Parse and check the catalogue expression EXPR (eg. '12*(POC*2 + GOC*50)').
+    Expressions are made of variable names, numbers, + - * / **, comparisons, & | ~ and the functions in _funcs.
+
+    Returns:
+        ast node, list of str : parsed expression, and the variable names it uses
+    """
+    if expr not in _compiled:
+        tree=ast.parse(expr, mode='eval').body
+        names=[]
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call):
+                if not (isinstance(node.func, ast.Name) and node.func.id in _funcs) or node.keywords:
+                    raise ValueError('Unknown function in expression : ' + expr)
+            elif isinstance(node, ast.Name):
+                if node.id not in _funcs and node.id not in names:
+                    names.append(node.id)
+            elif isinstance(node, ast.Constant):
+                if not isinstance(node.value, (int, float)):
+                    raise ValueError('Only numbers are allowed as constants in expression : ' + expr)
+            elif not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Load, ast.expr_context)
+                                + tuple(_binops) + tuple(_cmpops) + tuple(_unops)):
+                raise ValueError('Unsupported syntax ({0}) in expression : {1}'.format(type(node).__name__, expr))
+        _compiled[expr]=(tree, names)
+    return _compiled[expr]
+
+
+def exprnames(expr):
+    """
+    Variables (or catalogue entries) used by the expression EXPR.
+    """
+    return compileexpr(expr)[1]
+
+
+def _evalnode(node, blocks, dtype):
+    # Evaluate NODE on one block. Variables are copied (and cast to DTYPE) once, and the operators then work
+    # in place on these block-sized arrays, so that no temporary is ever larger than a block.
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        return np.array(blocks[node.id], dtype=dtype)
+    if isinstance(node, ast.UnaryOp):
+        a=_evalnode(node.operand, blocks, dtype)
+        if isinstance(a, np.ndarray) and not isinstance(node.op, ast.Invert):
+            return _unops[type(node.op)](a, out=a)
+        return _unops[type(node.op)](a)
+    if isinstance(node, ast.BinOp):
+        f=_binops[type(node.op)]
+        a=_evalnode(node.left, blocks, dtype)
+        b=_evalnode(node.right, blocks, dtype)
+        if f in (np.logical_and, np.logical_or):
+            return f(a, b)
+        rt=np.result_type(a, b)
+        for out in [a, b]:
+            if isinstance(out, np.ndarray) and out.dtype==rt and (rt.kind=='f' or f not in (np.true_divide, np.power)):
+                return f(a, b, out=out)
+        return f(a, b)
+    if isinstance(node, ast.Compare):
+        a=_evalnode(node.left, blocks, dtype)
+        res=None
+        for op, right in zip(node.ops, node.comparators):
+            b=_evalnode(right, blocks, dtype)
+            c=_cmpops[type(op)](a, b)
+            res=c if res is None else np.logical_and(res, c, out=res)
+            a=b
+        return res
+    return _funcs[node.func.id](*[_evalnode(a, blocks, dtype) for a in node.args])
+
+
+def _blocks(shape, blocksize):
+    # Slices of an array of SHAPE, in blocks of about BLOCKSIZE elements along the last axes
+    if int(np.prod(shape))<=blocksize:
+        yield ()
+        return
+    inner=1
+    a=len(shape)
+    while a>0 and inner*shape[a-1]<=blocksize:
+        a-=1
+        inner*=shape[a]
+    step=max(1, blocksize//inner)
+    for idx in np.ndindex(*shape[:a-1]):
+        for s in range(0, shape[a-1], step):
+            yield idx+(slice(s, s+step),)
+
+
+def _evalblocks(tree, names, arrays, dtype, blocksize):
+    shape=np.broadcast_shapes(*[np.shape(a) for a in arrays])
+    views=[np.broadcast_to(a, shape) for a in arrays]
+    out=None
+    for blk in _blocks(shape, blocksize):
+        r=_evalnode(tree, dict(zip(names, [v[blk] for v in views])), dtype)
+        if out is None:
+            out=np.empty(shape, dtype=np.result_type(r))
+        out[blk]=r
+    return out
+
+
+def evalexpr(x, expr, dtype=None, blocksize=65536):
+    """
+    Evaluate the pointwise expression EXPR (see compileexpr) on the variables of X, in a single pass.
+    The result is computed block by block (of BLOCKSIZE elements) directly into the output array : unlike xarray operators,
+    no full-size temporary is allocated for the intermediate results. With dask (lazy) variables, each chunk is evaluated alike.
+
+    Args:
+        x (xarray): xarray containing the variables of the expression
+        expr (str): expression (eg. '12*(POC*2 + GOC*50)')
+        dtype (str): if given (eg. 'float32'), the computation is done with this type. Otherwise with the type of the variables.
+        blocksize (int): number of elements per block
+
+    Returns:
+        DataArray : result of the expression
+    """
+    import xarray as xr
+    tree, names = compileexpr(expr)
+    args=[x[n] for n in names]
+    # type of the result, from a one-element sample (whose values are meaningless : no warning)
+    with np.errstate(all='ignore'):
+        rt=np.result_type(_evalnode(tree, {n : np.zeros(1, dtype=x[n].dtype) for n in names}, dtype))
+    return xr.apply_ufunc(lambda *a : _evalblocks(tree, names, a, dtype, blocksize), *args,
+                          dask='parallelized', output_dtypes=[rt])
+
+
+def loadcatalogue(f):
+    """
+    Add the entries of the YAML catalogue F to the catalogue (requires the PyYAML package). Entries are declared as an expression
+    of model variables or catalogue entries ('expr'), or as a vertical reduction ('vred', without 'where'), eg. :
+
+        NtoP :
+          expr : NO3/PO4
+          attrs : {units : '-'}
+          desc : Nitrate to phosphate ratio
+        pocI200 :
+          vred : [{op : integrate, v : poc, lower : 200}]
+          zwin : [null, 200]
+          attrs : {units : 'mmol C m-2'}
+
+    'req' is derived from the expression or the reductions if not given, and 'attrs' are completed with the defaults of the catalogue.
+
+    Returns:
+        list of str : the added entries
+    """
+    import yaml
+    with open(f) as fid:
+        entries=yaml.safe_load(fid) or {}
+
+    for key, e in entries.items():
+        e=dict(e)
+        if 'expr' in e:
+            e.setdefault('req', exprnames(e['expr']))
+            threeD=any([is3D(n) for n in exprnames(e['expr'])])
+            e['f']=lambda x, expr=e['expr'] : evalexpr(x, expr)
+        elif 'vred' in e:
+            if any(['where' in r for r in e['vred']]):
+                raise ValueError(key + ' : conditions (where) of vertical reductions are not available in YAML catalogues')
+            e.setdefault('req', [r['v'] for r in e['vred'] if r['v'] not in ['deptht']]+['deptht'])
+            threeD=False
+            e['f']=lambda x, key=key : vreduce(x, [key])[key]
+        else:
+            raise ValueError(key + ' : catalogue entries should have an expression (expr) or vertical reductions (vred)')
+        attrs={'units' : '', 'long_name' : e.get('desc', key), 'valid_min' : -1e20, 'valid_max' : 1e20,
+               'cell_methods' : 'time: mean', 'coordinates' : 'lon lat deptht' if threeD else 'lon lat'}
+        attrs.update(e.get('attrs', {}))
+        e['attrs']=attrs
+        e.setdefault('desc', attrs['long_name'])
+        ddiag2D[key]=e
+    return list(entries)
+
+
 def diaglist(keys=ddiag2D.keys()):
     for k in keys:
         print( "{0:<10}".format(k) + ' - [' + ddiag2D[k]['attrs']['units'] + '] : ' + ddiag2D[k]['desc'])
@@ -0,0 +1,674 @@
+import os
+import json
+import shutil
+import numpy as np
+import xarray as xr
+import DiagFunctions_NEMOPISCES as diag
+import DiagProfile_NEMOPISCES as prof
+import DiagAggregate_NEMOPISCES as agg
+from DiagProfile_NEMOPISCES import timed
+
+# Input/Output handling for the diagnostics of PISCES outputs
+# Loading of the 'ptrc', 'diad' and 'gridT' file triplets
+
+
+def openfile(f, keep=None, chunks=None, load=True):
+    """
+    Open a NEMO-PISCES output file
+
+    Args:
+        f (str): path to the netcdf file
+        keep (list of str): if given, only these variables are retained (together with the deptht bounds).
+        chunks (dict): if given, the file is opened lazily with these (dask) chunks. Otherwise the file is loaded in memory.
+        load (bool): if False (and no CHUNKS), the file is opened lazily without dask: data is read when (and where) it is indexed.
+
+    Returns:
+        xarray : the file content, or None if none of the KEEP variables is in the file
+    """
+    if chunks is None and keep is None and load:
+        return xr.load_dataset(f)
+
+    x=xr.open_dataset(f, chunks=chunks)
+    if keep is not None:
+        kept=[v for v in keep if v in x.data_vars]
+        if not kept:
+            x.close()
+            return None
+        if 'deptht' in x.coords and 'bounds' in x['deptht'].attrs:
+            kept.append(x['deptht'].attrs['bounds'])
+        x=x.drop_vars([v for v in x.data_vars if v not in kept])
+    if chunks is None and load:
+        x.load()
+    return x
+
+
+def loadfiles(fp, fd, fg, keep=None, chunks=None, verbose=False, profile=None, load=True):
+    """
+    Load and merge a triplet of 'ptrc', 'diad' and 'gridT' files, and add the cell height 'h' required by xgcm.
+
+    Args:
+        fp (str): 'ptrc' file
+        fd (str): 'diad' file (skipped if absent)
+        fg (str): 'gridT' file (skipped if absent)
+        keep (list of str): if given, only these variables are read (see requiredvars in DiagFunctions_NEMOPISCES)
+        chunks (dict): if given, files are opened lazily with these chunks and data is read only when used.
+        profile (dict): if given, the wall time of the loading stages is added to profile['stages'] (see DiagProfile_NEMOPISCES)
+        load (bool): if False, files are opened lazily without dask (see openfile)
+
+    Returns:
+        xarray : merged dataset
+    """
+    # 1: 'ptrc' files
+    # always opened, as it provides the time axis (time_counter_bounds is used to align the diad files)
+    with timed(profile, 'load ptrc'):
+        x_p=openfile(fp, keep=None if keep is None else list(keep)+['time_counter_bounds','time_centered'], chunks=chunks, load=load)
+    xl=[x_p]
+    # 2: 'diad' files
+    if os.path.isfile(fd):
+        with timed(profile, 'load diad'):
+            x_d=openfile(fd, keep=keep, chunks=chunks, load=load)
+        if x_d is not None:
+            #FIXME TPP is now provided as time instant.
+            # For now I just overwrite and assume time_centered coordinates instead.
+            x_d=x_d.assign(time_counter=x_p['time_counter'].data )
+            x_d=x_d.assign(time_counter_bounds=(('time_counter', 'axis_nbounds'), x_p['time_counter_bounds'].data) ) #FIXME MANIP on origin of time_counter
+            xl.append(x_d)
+    # 3: 'gridT' files
+    if os.path.isfile(fg):
+        with timed(profile, 'load gridT'):
+            x_g=openfile(fg, keep=keep, chunks=chunks, load=load)
+        if x_g is not None:
+            xl.append(x_g)
+
+    # Ensure we got all we may need
+    with timed(profile, 'merge'):
+        x_a=xr.merge(xl)
+
+    if verbose and keep is not None:
+        print('Variables read : ' + ' ; '.join(x_a.data_vars))
+
+    # Need to define a cell height variable to use xgcm
+    ### 16032022 AC - Had to replace 'depth_bounds' with x_a['deptht'].attrs['bounds'].
+    ### Maybe similar handling will be needed for other variable names, in which case it should be done in a more organized way
+    with timed(profile, 'h'):
+        x_a['h']=(x_a[x_a['deptht'].attrs['bounds']][:,1:]-x_a[x_a['deptht'].attrs['bounds']][:,:-1]).squeeze()
+    x_a['h'].attrs={'units'     : 'm',
+              'long_name' : 'cells height',
+              'valid_min' : -1e20,
+              'valid_max' : 1e20,
+              'cell_methods' : 'time: mean',
+              'coordinates': 'lon lat deptht'}
+    return x_a
+
+
+def readstate(state):
+    """
+    Read the completion records of a batch.
+
+    Args:
+        state (str): state file, with one json record per completed output file
+
+    Returns:
+        dict : last record of each output file
+    """
+    records={}
+    if state is not None and os.path.isfile(state):
+        with open(state) as f:
+            for line in f:
+                try:
+                    r=json.loads(line)
+                except ValueError:
+                    # line truncated by an interrupted run
+                    continue
+                records[r['file']]=r
+    return records
+
+
+def recordstate(state, fo):
+    """
+    Append the completion record of the output file FO (diagnostics it contains and modification time) to the state file.
+    """
+    with xr.open_dataset(fo) as x:
+        r={'file':fo, 'diags':list(x.data_vars), 'mtime':os.path.getmtime(fo)}
+    with open(state,'a') as f:
+        f.write(json.dumps(r)+'\n')
+
+
+def missingdiags(fp, fd, fg, fo, dlist, records=None):
+    """
+    Diagnostics of DLIST still to be computed for an output file.
+    An output file older than one of its inputs is computed again entirely.
+    Otherwise, the diagnostics it contains are taken from its completion record, or from its header.
+
+    Args:
+        fp, fd, fg (str): 'ptrc', 'diad' and 'gridT' files
+        fo (str): output 'diag' file
+        dlist (list of str): identifiers of the diagnostics
+        records (dict): completion records (see readstate)
+
+    Returns:
+        list of str, bool : diagnostics to compute, and whether they should be appended to the existing FO
+    """
+    if not os.path.isfile(fo):
+        return dlist, False
+    mtime=os.path.getmtime(fo)
+    if any([os.path.getmtime(f)>mtime for f in [fp, fd, fg] if os.path.isfile(f)]):
+        return dlist, False
+
+    r=(records or {}).get(fo)
+    if r is not None and r['mtime']==mtime:
+        have=r['diags']
+    else:
+        try:
+            with xr.open_dataset(fo) as x:
+                have=list(x.data_vars)
+        except Exception:
+            # unreadable, eg. left incomplete by a killed job
+            return dlist, False
+    return [d for d in dlist if d not in have], True
+
+
+def writerecords(f, x, t0, encoding=None):
+    """
+    Write the records of X in the file F, starting at record T0 of time_counter.
+    The file is created at T0=0, with time_counter as unlimited dimension. Further records are appended.
+
+    Args:
+        f (str): output netcdf file
+        x (xarray): block of records to write
+        t0 (int): index of the first record of X in F
+        encoding (dict): encoding used when creating the file
+    """
+    if t0==0:
+        x.to_netcdf(f, unlimited_dims=['time_counter'], encoding=encoding)
+        return
+
+    writeregion(f, x, {'time_counter':slice(t0, t0+x.sizes['time_counter'])})
+
+
+def writeregion(f, x, region):
+    """
+    Write the variables of X in a region of the existing netcdf file F.
+    Variables without any dimension of the region are skipped.
+
+    Args:
+        f (str): netcdf file, with the variables of X
+        x (xarray): data to write
+        region (dict): slice of the file along each dimension of the region (eg. {'y':slice(0,100), 'x':slice(200,300)})
+    """
+    import netCDF4
+    # the netcdf/hdf5 library is not thread safe : share the lock of the xarray readers (eg. tiles read by threads)
+    from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(f, 'a') as nc:
+        for v in x.variables:
+            if not set(region)&set(x[v].dims):
+                continue
+            ncv=nc.variables[v]
+            # encode as in the file (eg. datetime to 'seconds since ...')
+            xv=x[v].variable.copy(deep=False)
+            xv.encoding={k : ncv.getncattr(k) for k in ['units','calendar'] if k in ncv.ncattrs()}
+            xv.encoding['dtype']=ncv.dtype
+            data=xr.conventions.encode_cf_variable(xv).transpose(*ncv.dimensions).values
+            ncv[tuple([region.get(d, slice(None)) for d in ncv.dimensions])]=data
+
+
+def outputchunks(da, chunking, nt=None):
+    """
+    Chunk shape of a diagnostic in the output.
+
+    Args:
+        da (DataArray): diagnostic, with dimensions (time_counter, y, x)
+        chunking (str): 'map' for reading maps (one record per chunk), 'series' for reading time series (all records of the file, 64x64 columns per chunk)
+        nt (int): number of records in the file, if larger than in DA (written by blocks)
+
+    Returns:
+        tuple : chunk shape, or None for the default chunking
+    """
+    if chunking is None:
+        return None
+    nt=nt or da.sizes.get('time_counter',1)
+    shape=[]
+    for d in da.dims:
+        if d=='time_counter':
+            shape.append(1 if chunking=='map' else nt)
+        elif chunking=='series':
+            shape.append(min(da.sizes[d],64))
+        else:
+            shape.append(da.sizes[d])
+    return tuple(shape)
+
+
+def outputencoding(x, dlist, output=None, nt=None):
+    """
+    Encoding of the diagnostics DLIST of X, for to_netcdf or to_zarr.
+
+    Args:
+        x (xarray): computed diagnostics
+        dlist (list of str): identifiers of the diagnostics
+        output (dict): output options
+            'compress' (int): zlib compression level (with shuffle), netcdf only. 0 or None for no compression.
+            'float32' (bool): store as float32
+            'pack' (bool): store as int16 packed with scale_factor and add_offset, computed from the range of each diagnostic in X
+            'chunking' (str): 'map' or 'series' (see outputchunks)
+            'zarr' (str): zarr store, if used instead of netcdf files
+        nt (int): number of records in the file (see outputchunks)
+
+    Returns:
+        dict : encoding of each diagnostic
+    """
+    output=output or {}
+    zarr=output.get('zarr') is not None
+    encoding={}
+    for v in dlist:
+        e={}
+        if output.get('pack'):
+            vmin=float(x[v].min())
+            vmax=float(x[v].max())
+            if np.isfinite(vmin) and np.isfinite(vmax):
+                e.update(dtype='int16', scale_factor=(vmax-vmin)/65533 if vmax>vmin else 1.,
+                         add_offset=(vmax+vmin)/2, _FillValue=np.int16(-32768))
+            else:
+                e['dtype']='float32'
+        elif output.get('float32'):
+            e['dtype']='float32'
+        if output.get('compress') and not zarr:
+            e.update(zlib=True, complevel=output['compress'], shuffle=True)
+        chunks=outputchunks(x[v], output.get('chunking'), nt)
+        if chunks is not None:
+            e['chunks' if zarr else 'chunksizes']=chunks
+        encoding[v]=e
+    return encoding
+
+
+def alignedchunks(n, size, t0=0):
+    """
+    Dask chunks of N values written from the index T0 of a zarr array chunked by SIZE, so that no dask chunk overlaps two zarr chunks.
+    """
+    first=min(n, size-t0%size)
+    rest=n-first
+    return (first,)+(size,)*(rest//size)+((rest%size,) if rest%size else ())
+
+
+def misalignedchunks(x, chunks, t0=0):
+    """
+    Variables of X whose dask chunks overlap several of their zarr CHUNKS (dict of chunk shapes), when written from the record T0.
+    """
+    bad=[]
+    for k, c in chunks.items():
+        if c is None:
+            continue
+        for dchunks, size, start in zip(x[k].chunks, c, (t0,0,0)):
+            if any([(start+b)%size for b in np.cumsum(dchunks)[:-1]]):
+                bad.append(k)
+                break
+    return bad
+
+
+def preparezarr(flist, dlist, output, workers=1):
+    """
+    Create (or extend) the zarr store output['zarr'] receiving the diagnostics of all the files in FLIST.
+    The time axis of the store covers the records of all files, so that each file can be written in its own region, in any order.
+    New records are appended to all the variables of the store (not only DLIST), and should follow the records already in the store.
+    The chunks of a new store follow output['chunking'], with 'series' chunks of the largest number of records that divides the length
+    of all files, so that chunks are not shared by two files. An existing store keeps its own chunks.
+    Run this before processing the files.
+
+    Args:
+        flist (list of str): 'ptrc' files
+        dlist (list of str): identifiers of the diagnostics
+        output (dict): output options (see outputencoding)
+        workers (int): number of processes writing the files concurrently
+
+    Returns:
+        dict : index of the first record of each file in the store
+
+    Raises:
+        ValueError : if new records fall before the last record of the store, if the chunks of the store cannot receive the new records
+                     or variables, if the records of a file are not contiguous in the store, or if, with several WORKERS,
+                     a chunk of the store is shared by the records of two files. Nothing is written in the first two cases.
+    """
+    import dask.array as da
+
+    times=[]
+    for f in flist:
+        with xr.open_dataset(f) as x:
+            times.append(x['time_counter'].values)
+            if f==flist[0]:
+                # horizontal coordinates (nav_lon, nav_lat)
+                xref=xr.Dataset(coords={c : x[c].load() for c in x.coords if set(x[c].dims)<={'y','x'} and x[c].dims})
+                shape=(x.sizes['y'], x.sizes['x'])
+    nt=int(np.gcd.reduce([len(t) for t in times]))
+
+    def template(t, keys, chunks, attrs={}, t0=0):
+        # KEYS on the records T, with dask chunks aligned on their zarr CHUNKS from the record T0
+        x=xref.assign_coords(time_counter=('time_counter', t))
+        for k in keys:
+            x[k]=(('time_counter','y','x'), da.zeros((len(t),)+shape, chunks=(1,)+shape))
+            if chunks[k] is not None:
+                x[k]=x[k].chunk(dict(zip(x[k].dims, [alignedchunks(n, c, s) for n, c, s in zip(x[k].shape, chunks[k], (t0,0,0))])))
+            x[k].attrs=attrs[k] if k in attrs else diag.ddiag2D[k]['attrs']
+        return x
+
+    def encoding(x, keys, chunks):
+        e=outputencoding(x, keys, output, nt=nt)
+        for k in keys:
+            if chunks[k] is not None:
+                e[k]['chunks']=chunks[k]
+        return e
+
+    store=output['zarr']
+    alltimes=np.unique(np.concatenate(times))
+    if not os.path.exists(store):
+        c=outputchunks(xr.DataArray(da.zeros((len(alltimes),)+shape), dims=('time_counter','y','x')), output.get('chunking'), nt)
+        chunks={k : c for k in dlist}
+        x=template(alltimes, dlist, chunks)
+        x.to_zarr(store, compute=False, encoding=encoding(x, dlist, chunks))
+    else:
+        with xr.open_zarr(store) as x:
+            stimes=x['time_counter'].values
+            missing=[k for k in dlist if k not in x.data_vars]
+            # all the variables along time_counter must be extended together, with the chunks of the store
+            sattrs={k : dict(x[k].attrs) for k in x.data_vars if 'time_counter' in x[k].dims}
+            chunks={k : tuple(x[k].encoding['chunks']) for k in sattrs}
+        with xr.open_zarr(store, decode_coords=False) as x:
+            # global attributes, including the 'coordinates' of nav_lon and nav_lat
+            gattrs=dict(x.attrs)
+        # new variables are chunked as the others
+        chunks.update({k : next(iter(chunks.values()), None) for k in missing})
+        new=alltimes[~np.isin(alltimes, stimes)]
+        if len(new) and len(stimes) and new[0]<stimes[-1]:
+            raise ValueError('Records of {0} fall before the last record of {1} ({2}), they cannot be appended'.format(
+                                ', '.join([f for f, t in zip(flist, times) if np.isin(t, new).any() and t[0]<stimes[-1]]), store, stimes[-1]))
+
+        # all templates are checked before anything is written, so that the store is not left half-extended
+        writes=[]
+        if len(missing):
+            x=template(stimes, missing, chunks)
+            writes.append((x, {'mode':'a', 'encoding':encoding(x, missing, chunks)}, 0))
+        if len(new):
+            # the horizontal coordinates are already in the store. Appending rewrites the global attributes : they are kept.
+            x=template(new, list(sattrs)+missing, chunks, attrs=sattrs, t0=len(stimes)).drop_vars(list(xref.coords))
+            x.attrs=gattrs
+            writes.append((x, {'append_dim':'time_counter'}, len(stimes)))
+        for x, kwargs, t0 in writes:
+            bad=misalignedchunks(x, {k : chunks[k] for k in x.data_vars}, t0)
+            if bad:
+                raise ValueError('The chunks of {0} in {1} cannot receive the new records'.format(', '.join(bad), store))
+        for x, kwargs, t0 in writes:
+            x.to_zarr(store, compute=False, **kwargs)
+
+    with xr.open_zarr(store) as x:
+        stimes=x['time_counter'].values
+        tchunks={x[k].encoding['chunks'][0] for k in x.data_vars if 'time_counter' in x[k].dims}
+    offsets={ f : int(np.flatnonzero(stimes==t[0])[0]) for f, t in zip(flist, times) }
+    for f, t in zip(flist, times):
+        if not np.array_equal(stimes[offsets[f]:offsets[f]+len(t)], t):
+            raise ValueError('The records of ' + f + ' are not contiguous in ' + store)
+    if workers>1:
+        # files are written concurrently in their region : a chunk shared by two files could be overwritten
+        files={}
+        for f, t in zip(flist, times):
+            for c in tchunks:
+                for i in range(offsets[f]//c, (offsets[f]+len(t)-1)//c+1):
+                    files.setdefault((c, i), []).append(f)
+        shared=sorted(set([f for fc in files.values() if len(fc)>1 for f in fc]))
+        if shared:
+            raise ValueError('The records of {0} share chunks of {1} with other files : they cannot be written by several workers'.format(
+                                ', '.join(shared), store))
+    return offsets
+
+
+def writezarr(x, output, t0=0):
+    """
+    Write the diagnostics in X to their region of the zarr store output['zarr'], starting at the record output['offset']+T0.
+    """
+    # the coordinates are written by preparezarr : time_counter is left out too, as its chunks are shared by all files
+    x=x.drop_vars(list(x.coords))
+    t0=output['offset']+t0
+    # With several workers, chunks are only shared by records of the same file (see preparezarr), written by a single process
+    x.to_zarr(output['zarr'], region={'time_counter':slice(t0, t0+x.sizes['time_counter'])}, safe_chunks=False)
+
+
+def tileslices(ny, nx, tile):
+    """
+    Horizontal tiles of a (NY, NX) grid.
+
+    Args:
+        tile (tuple): size (y, x) of the tiles
+
+    Returns:
+        list of tuples : (y, x) slices of each tile
+    """
+    ty, tx = tile
+    return [ (slice(y0, min(y0+ty, ny)), slice(x0, min(x0+tx, nx)))
+                for y0 in range(0, ny, ty) for x0 in range(0, nx, tx) ]
+
+
+def processtile(fp, fd, fg, dlist, ys, xs, keep=None, wet=False, dtype=None):
+    """
+    Compute the diagnostics DLIST on a horizontal tile of a triplet of 'ptrc', 'diad' and 'gridT' files.
+    Only the tile is read from the files.
+
+    Args:
+        fp, fd, fg (str): 'ptrc', 'diad' and 'gridT' files
+        dlist (list of str): identifiers of the diagnostics
+        ys, xs (slice): tile along y and x
+        keep : see loadfiles
+        wet (bool): if True, the diagnostics are computed on the ocean columns of the tile only
+        dtype (str): type of the computation of expressions (see add2D)
+
+    Returns:
+        xarray : diagnostics on the tile
+    """
+    x_a=loadfiles(fp, fd, fg, keep=keep, load=False)
+    x_t=x_a.isel(y=ys, x=xs).load()
+    x_a.close()
+    if wet:
+        cols=diag.wetcolumns(x_t)
+        bibi=diag.add2D(diag.compact(x_t, cols), dlist, verbose=False, free=True, dtype=dtype)
+        return diag.expand(bibi[dlist], cols, x_t).load()
+    bibi=diag.add2D(x_t, dlist, verbose=False, free=True, dtype=dtype)
+    return bibi[dlist].load()
+
+
+def processtiles(fp, fd, fg, f, dlist, tile, tileworkers=1, tilepool='thread', keep=None, wet=False, output=None, verbose=False, dtype=None):
+    """
+    Compute the diagnostics DLIST tile by tile (see processtile), on a pool of threads or processes, and write each tile in its region of F.
+    Memory is bounded by the size of the tiles being processed, whatever the size of the grid.
+
+    Args:
+        fp, fd, fg (str): 'ptrc', 'diad' and 'gridT' files
+        f (str): output netcdf file (created)
+        dlist (list of str): identifiers of the diagnostics
+        tile (tuple): size (y, x) of the tiles
+        tileworkers (int): number of tiles processed concurrently
+        tilepool (str): 'thread' or 'process'
+        keep, wet, dtype : see processtile
+        output (dict): output options (see outputencoding)
+    """
+    import multiprocessing
+    import dask.array as da
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    x_a=loadfiles(fp, fd, fg, keep=keep, load=False)
+    ny, nx = x_a.sizes['y'], x_a.sizes['x']
+    tiles=tileslices(ny, nx, tile)
+    if verbose:print('{0} tiles of {1} x {2}'.format(len(tiles), *tile))
+
+    if tilepool=='process':
+        # see runbatch in DiagBatch_NEMOPISCES
+        context=multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        pool=ProcessPoolExecutor(max_workers=tileworkers, mp_context=context)
+    else:
+        pool=ThreadPoolExecutor(max_workers=tileworkers)
+
+    # Tiles are submitted in a window of 2*TILEWORKERS, and each tile is dropped once written,
+    # so that at most 2*TILEWORKERS tiles are held in memory
+    pending=list(tiles)
+    futures={}
+    n=0
+    with pool:
+        while pending or futures:
+            while pending and len(futures)<2*tileworkers:
+                ys, xs = pending.pop(0)
+                futures[pool.submit(processtile, fp, fd, fg, dlist, ys, xs, keep=keep, wet=wet, dtype=dtype)]=(ys, xs)
+            future=next(iter(wait(futures, return_when=FIRST_COMPLETED)[0]))
+            ys, xs = futures.pop(future)
+            r=future.result()
+            del future
+            if n==0:
+                # Create the output file from the structure of the first tile
+                xf=xr.Dataset(coords={c : x_a[c] for c in x_a.coords if set(x_a[c].dims)<={'y','x'} and x_a[c].dims})
+                xf=xf.assign_coords(time_counter=r['time_counter'])
+                for v in dlist:
+                    shape=tuple([ny if d=='y' else nx if d=='x' else r.sizes[d] for d in r[v].dims])
+                    chunks=tuple([1 if d=='time_counter' else s for d, s in zip(r[v].dims, shape)])
+                    xf[v]=(r[v].dims, da.full(shape, np.nan, dtype=r[v].dtype, chunks=chunks), r[v].attrs)
+                xf.to_netcdf(f, encoding=outputencoding(xf, dlist, output))
+                del xf
+            writeregion(f, r[dlist], {'y':ys, 'x':xs})
+            if verbose:print('tile y={0}:{1} x={2}:{3} written'.format(ys.start, ys.stop, xs.start, xs.stop))
+            del r
+            n+=1
+    x_a.close()
+
+
+def processfiles(fp, fd, fg, fo, dlist, keep=None, chunks=None, verbose=False, append=False, state=None, block=None, output=None, profile=False, wet=False,
+                 tile=None, tileworkers=1, tilepool='thread', aggregate=None, dtype=None):
+    """
+    Compute the diagnostics DLIST for a triplet of 'ptrc', 'diad' and 'gridT' files, and write them in FO.
+    The output is written in a temporary file first, so that FO is never left incomplete.
+
+    Args:
+        fp, fd, fg (str): 'ptrc', 'diad' and 'gridT' files
+        fo (str): output 'diag' file
+        dlist (list of str): identifiers of the diagnostics
+        keep, chunks : see loadfiles
+        append (bool): if True, the diagnostics are added to the existing FO
+        state (str): if given, the completion of FO is recorded in this file (see readstate)
+        block (int): if given, the records of time_counter are read, computed and written by blocks of BLOCK records.
+        output (dict): output options (see outputencoding). If output['zarr'] is given, the diagnostics are written
+                       in this store from the record output['offset'] (see preparezarr), instead of FO.
+        profile (bool): if True, the processing is profiled (see DiagProfile_NEMOPISCES)
+        wet (bool): if True, the diagnostics are computed on the ocean columns only (see wetcolumns in DiagFunctions_NEMOPISCES)
+        tile, tileworkers, tilepool : if TILE is given, the diagnostics are computed by horizontal tiles (see processtiles)
+        aggregate (list of str): if given, the diagnostics are also accumulated by these groupings (see DiagAggregate_NEMOPISCES)
+        dtype (str): if given (eg. 'float32'), the expressions of the catalogue are computed with this type (see evalexpr in DiagFunctions_NEMOPISCES)
+
+    Returns:
+        dict : 'profile' of the processing (or None), and 'aggregate' accumulator of the diagnostics of the file (or None)
+    """
+    # with lazy loading (and without blocks or tiles, which are loaded), diagnostics are computed when written
+    profile=prof.newprofile(fo, lazy=chunks is not None and block is None and tile is None) if profile else None
+    acc=agg.newaccumulator(aggregate) if aggregate else None
+    output=output or {}
+    zarr=output.get('zarr') is not None
+    ftmp=fo+'.part'
+
+    if tile is not None:
+        if output.get('pack'):
+            # the range of the diagnostics is not known from the first tile
+            print('Packing is not available with tiles, diagnostics are stored as float32')
+            output=dict(output, pack=False, float32=True)
+        fnew=fo+'.new.part' if append else ftmp
+        with timed(profile, 'tiles'):
+            processtiles(fp, fd, fg, fnew, dlist, tile, tileworkers=tileworkers, tilepool=tilepool, keep=keep, wet=wet, output=output, verbose=verbose, dtype=dtype)
+        if append:
+            with timed(profile, 'write'):
+                with xr.open_dataset(fo) as xo, xr.open_dataset(fnew) as xn:
+                    xr.merge([xo, xn], compat='override').to_netcdf(ftmp)
+            os.remove(fnew)
+        # for closing below
+        x_a=xr.Dataset()
+    elif block is None:
+        x_a=loadfiles(fp, fd, fg, keep=keep, chunks=chunks, verbose=verbose, profile=profile)
+
+        if wet:
+            with timed(profile, 'compact'):
+                cols=diag.wetcolumns(x_a)
+                x_w=diag.compact(x_a, cols)
+                if chunks is None:
+                    # the full grid is not needed anymore
+                    x_a=x_a.drop_vars([v for v in x_a.data_vars if {'y','x'}<=set(x_a[v].dims)])
+            if verbose:print('{0} ocean columns out of {1}'.format(int(cols['wet'].sum()), cols['wet'].size))
+            with timed(profile, 'diagnostics'):
+                bibi=diag.add2D(x_w,dlist, verbose=verbose, free=True, profile=profile, dtype=dtype)
+            with timed(profile, 'expand'):
+                bibi=diag.expand(bibi[dlist], cols, x_a)
+        else:
+            with timed(profile, 'diagnostics'):
+                bibi=diag.add2D(x_a,dlist, verbose=verbose, free=True, profile=profile, dtype=dtype)
+
+        if acc is not None:
+            with timed(profile, 'aggregate'):
+                if chunks is not None:
+                    # computed once, for both the aggregates and the output
+                    bibi=bibi[dlist].load()
+                agg.accumulate(acc, bibi[dlist], dlist, agg.recordweights(x_a))
+
+        # With lazy loading, this is also where the data is read and the diagnostics computed
+        with timed(profile, 'write'):
+            if zarr:
+                writezarr(bibi[dlist], output)
+            elif append:
+                shutil.copyfile(fo, ftmp)
+                bibi[dlist].to_netcdf(ftmp, mode='a', encoding=outputencoding(bibi, dlist, output))
+            else:
+                bibi[dlist].to_netcdf(ftmp, encoding=outputencoding(bibi, dlist, output))
+    else:
+        # Files are opened lazily, and only one block of records is in memory at a time
+        x_a=loadfiles(fp, fd, fg, keep=keep, chunks={'time_counter':block}, verbose=verbose, profile=profile)
+        fblock=fo+'.new.part' if append else ftmp
+        # keep the time units of the inputs, so that all blocks can be encoded alike
+        encoding={v : {'units':x_a[v].encoding['units'], 'dtype':'float64', '_FillValue':None}
+                    for v in x_a.coords if 'time_counter' in x_a[v].dims and 'units' in x_a[v].encoding}
+        if output.get('pack') and not zarr:
+            # the range of the diagnostics is not known from the first block
+            print('Packing is not available with --block, diagnostics are stored as float32')
+            output=dict(output, pack=False, float32=True)
+        nt=x_a.sizes['time_counter']
+        if wet:
+            with timed(profile, 'compact'):
+                cols=diag.wetcolumns(x_a)
+        for t0 in range(0, nt, block):
+            with timed(profile, 'load block'):
+                if wet:
+                    xb=diag.compact(x_a.isel(time_counter=slice(t0, t0+block)), cols).load()
+                else:
+                    xb=x_a.isel(time_counter=slice(t0, t0+block)).load()
+            with timed(profile, 'diagnostics'):
+                bibi=diag.add2D(xb,dlist, verbose=verbose, free=True, profile=profile, dtype=dtype)
+            if wet:
+                with timed(profile, 'expand'):
+                    bibi=diag.expand(bibi[dlist], cols, x_a)
+            if acc is not None:
+                with timed(profile, 'aggregate'):
+                    agg.accumulate(acc, bibi[dlist], dlist, agg.recordweights(x_a.isel(time_counter=slice(t0, t0+block))))
+            with timed(profile, 'write'):
+                if zarr:
+                    writezarr(bibi[dlist], output, t0=t0)
+                else:
+                    if t0==0:
+                        encoding.update(outputencoding(bibi, dlist, output, nt=nt))
+                    writerecords(fblock, bibi[dlist], t0, encoding=encoding)
+            if verbose:print('records {0}-{1} of {2} written'.format(t0, min(t0+block,nt)-1, nt))
+            del xb, bibi
+        if append and not zarr:
+            with timed(profile, 'write'):
+                with xr.open_dataset(fo) as xo, xr.open_dataset(fblock) as xn:
+                    xr.merge([xo, xn], compat='override').to_netcdf(ftmp)
+            os.remove(fblock)
+
+    if zarr:
+        print(fo + ' completed (written to ' + output['zarr'] + ')')
+    else:
+        os.replace(ftmp, fo)
+
+        if state is not None:
+            recordstate(state, fo)
+
+        print(fo + (' completed with ' + ', '.join(dlist) if append else ' completed'))
+    x_a.close()
+    del x_a
+
+    return {'profile' : None if profile is None else prof.endprofile(profile), 'aggregate' : acc}
@@ -0,0 +1,141 @@
+import os
+import json
+from glob import glob
+import DiagFunctions_NEMOPISCES as diag
+
+# Index of a set of NEMO-PISCES outputs, built from the netcdf headers only : file triplets, variables, dimensions,
+# number of records and deptht bounds of each file. The index is checked against the requirements of the diagnostics
+# before any file is loaded, and cached in the directory of the outputs (see buildindex).
+# Only netCDF4 is used here (imported when needed), so that xarray is not loaded for the checks.
+
+INDEXVERSION=2
+
+
+def findtriplets(indir, key=''):
+    """
+    List the 'ptrc' files of INDIR (containing KEY if given), with the corresponding 'diad', 'gridT' and output 'diag' files.
+
+    Returns:
+        list of tuples : (ptrc, diad, gridT, diag) files
+    """
+    flist_p = glob(indir + '*ptrc*'+key+'*nc')
+    if not flist_p:
+        print("Couldn't any files of the form :"+indir + "*ptrc*"+key+"*nc")
+        flist_p = glob(indir +'*' +key+'*ptrc*nc')
+        if not flist_p:
+                print("Couldn't any files of the form :"+indir +'*' +key+'*ptrc*nc')
+    return [ (f, f.replace('ptrc','diad'), f.replace('ptrc','gridT'), f.replace('ptrc','diag')) for f in flist_p ]
+
+
+def readheader(f):
+    """
+    Read the header of the netcdf file F : dimensions, variables (with their dimensions), number of records, and the deptht levels and bounds (if any).
+    Only the (small) deptht variables are read, no data.
+
+    Returns:
+        dict : 'dims', 'variables', 'records', 'deptht', 'deptht_bounds', and 'mtime' and 'size' of the file (to validate the cache)
+    """
+    import netCDF4
+    with netCDF4.Dataset(f) as nc:
+        h={'mtime' : os.path.getmtime(f), 'size' : os.path.getsize(f),
+           'dims' : {d : len(nc.dimensions[d]) for d in nc.dimensions},
+           'variables' : {v : list(nc.variables[v].dimensions) for v in nc.variables},
+           'deptht' : None, 'deptht_bounds' : None}
+        h['records']=h['dims'].get('time_counter')
+        if 'deptht' in nc.variables:
+            h['deptht']=nc.variables['deptht'][:].filled(float('nan')).tolist()
+        if 'deptht' in nc.variables and 'bounds' in nc.variables['deptht'].ncattrs():
+            b=nc.variables['deptht'].getncattr('bounds')
+            if b in nc.variables:
+                h['deptht_bounds']=nc.variables[b][:].filled(float('nan')).tolist()
+    return h
+
+
+def buildindex(triplets, cache=None, verbose=False):
+    """
+    Index the headers of the files of TRIPLETS (see findtriplets). Missing 'diad' and 'gridT' files are allowed (and not indexed).
+
+    Args:
+        triplets (list of tuples): (ptrc, diad, gridT, diag) files
+        cache (str): json file of a previous index. Files that did not change since (same mtime and size) are not read again,
+                     and the index is saved in this file.
+
+    Returns:
+        dict : 'triplets', and the header of each indexed file in 'files' (see readheader). The header of a file that cannot be read
+               (eg. truncated, or still being written) is {'error' : str}, and is not cached.
+    """
+    old={}
+    if cache is not None and os.path.isfile(cache):
+        try:
+            with open(cache) as fid:
+                index=json.load(fid)
+            if index.get('version')==INDEXVERSION:
+                old=index['files']
+        except (OSError, ValueError, KeyError):
+            print('Index cache ' + cache + ' is not readable, rebuilt')
+
+    files={}
+    nread=0
+    for fp, fd, fg, fo in triplets:
+        for f in [fp, fd, fg]:
+            if f in files or not os.path.isfile(f):
+                continue
+            h=old.get(f)
+            if h is None or h['mtime']!=os.path.getmtime(f) or h['size']!=os.path.getsize(f):
+                try:
+                    h=readheader(f)
+                except OSError as e:
+                    h={'error' : repr(e)}
+                nread+=1
+            files[f]=h
+    if verbose:
+        print('Index : {0} files, {1} headers read, {2} from cache'.format(len(files), nread, len(files)-nread))
+
+    index={'version' : INDEXVERSION, 'triplets' : [list(t) for t in triplets], 'files' : files}
+    if cache is not None and (nread or set(files)!=set(old)):
+        try:
+            with open(cache+'.part', 'w') as fid:
+                json.dump(dict(index, files={f : h for f, h in files.items() if 'error' not in h}), fid)
+            os.replace(cache+'.part', cache)
+        except OSError as e:
+            print('Index not cached : ' + repr(e))
+    return index
+
+
+def checkindex(index, dlist):
+    """
+    Check that each triplet of the index provides what the diagnostics DLIST need : the raw variables of their dependency closure
+    (see requiredvars in DiagFunctions_NEMOPISCES), the deptht bounds used for the cell height, and the same number of records
+    in the 'ptrc' and 'diad' files. Files that could not be read are reported as such.
+
+    Returns:
+        list of tuples (diag file, str) : problems found, empty if all the triplets can be processed
+    """
+    need={k : diag.requiredvars(k) for k in dlist}
+    problems=[]
+    for fp, fd, fg, fo in index['triplets']:
+        unreadable=[f for f in [fp, fd, fg] if 'error' in index['files'].get(f, {})]
+        for f in unreadable:
+            problems.append((fo, 'cannot read ' + f + ' : ' + index['files'][f]['error']))
+        if unreadable:
+            continue
+        hs=[index['files'][f] for f in [fp, fd, fg] if f in index['files']]
+        hp=index['files'][fp]
+        available=set([v for h in hs for v in h['variables']])
+
+        missing={}
+        for k, vs in need.items():
+            for v in vs:
+                if v not in available:
+                    missing.setdefault(v, []).append(k)
+        for v, ks in missing.items():
+            problems.append((fo, 'missing variable ' + v + ' (needed by ' + ', '.join(ks) + ')'))
+
+        if hp['deptht_bounds'] is None:
+            problems.append((fo, 'no deptht bounds in ' + fp))
+        if fd in index['files'] and index['files'][fd]['records']!=hp['records']:
+            problems.append((fo, '{0} records in {1}, but {2} in {3}'.format(index['files'][fd]['records'], fd, hp['records'], fp)))
+        for h, f in [(index['files'].get(f), f) for f in [fd, fg]]:
+            if h is not None and 'deptht' in h['dims'] and h['dims']['deptht']!=hp['dims'].get('deptht'):
+                problems.append((fo, '{0} levels in {1}, but {2} in {3}'.format(h['dims']['deptht'], f, hp['dims'].get('deptht'), fp)))
+    return problems
@@ -0,0 +1,155 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+# Profiling of the diagnostics computation : wall time per stage and per diagnostic, peak memory, bytes read and written
+# A profile is a dictionnary filled along the processing of a file, and None when profiling is off.
+
+
+def iocounters():
+    """
+    Bytes read and written by the current process so far (Linux only, from /proc/self/io).
+
+    Returns:
+        int, int : bytes read and written, or None, None if not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io=dict([l.split(':') for l in f.read().split('\n') if ':' in l])
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def resetpeakrss():
+    """
+    Reset the peak resident memory of the current process (Linux only, through /proc/self/clear_refs), so that peakrss gives
+    the peak since this call.
+
+    Returns:
+        bool : True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peakrss():
+    """
+    Peak resident memory of the current process (bytes) : since the last resetpeakrss on Linux (VmHWM),
+    and over the lifetime of the process otherwise.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for l in f:
+                if l.startswith('VmHWM:'):
+                    return int(l.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    import resource
+    r=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform=='darwin' else r*1024
+
+
+def newprofile(label, lazy=False):
+    """
+    Start the profile of the processing of a file.
+    The peak memory of the process is reset where possible, so that it is the peak of this file (see 'peak_rss_scope').
+
+    Args:
+        label (str): name of the file
+        lazy (bool): True if the diagnostics are dask graphs, computed when written. Their time in 'diags' is then only
+                     the construction of the graph, and the computation is in the 'write' stage.
+
+    Returns:
+        dict : profile, to be completed with timed and closed with endprofile
+    """
+    rb, wb = iocounters()
+    scope='file' if resetpeakrss() else 'process'
+    return {'file' : label, 'stages' : {}, 'diags' : {}, 'lazy' : lazy, 'peak_rss_scope' : scope,
+            '_start' : time.perf_counter(), '_io' : (rb, wb)}
+
+
+@contextmanager
+def timed(profile, name, group='stages'):
+    """
+    Add the wall time of the enclosed block to profile[group][name]. Does nothing if PROFILE is None.
+    """
+    if profile is None:
+        yield
+        return
+    tic=time.perf_counter()
+    try:
+        yield
+    finally:
+        profile[group][name]=profile[group].get(name,0.)+time.perf_counter()-tic
+
+
+def endprofile(profile):
+    """
+    Close the profile of a file : total wall time, bytes read and written, peak resident memory of the process
+    (during this file, or since the start of the process if it could not be reset, see 'peak_rss_scope').
+    """
+    rb, wb = iocounters()
+    rb0, wb0 = profile.pop('_io')
+    profile['wall']=time.perf_counter()-profile.pop('_start')
+    profile['bytes_read']=None if rb is None else rb-rb0
+    profile['bytes_written']=None if wb is None else wb-wb0
+    profile['peak_rss']=peakrss()
+    return profile
+
+
+def summary(profiles):
+    """
+    Aggregate the profiles of a series of files.
+
+    Returns:
+        dict : total, mean and max time of each stage and diagnostic (sorted by total time), total bytes read and written, max peak memory,
+               and the number of lazy files (whose diagnostic times only cover the construction of the dask graphs)
+    """
+    def aggregate(group):
+        names=[]
+        for p in profiles:
+            names+=[n for n in p[group] if n not in names]
+        agg={}
+        for n in names:
+            t=[p[group][n] for p in profiles if n in p[group]]
+            agg[n]={'total':sum(t), 'mean':sum(t)/len(t), 'max':max(t), 'files':len(t)}
+        return dict(sorted(agg.items(), key=lambda a : -a[1]['total']))
+
+    def total(k):
+        v=[p[k] for p in profiles]
+        return None if None in v else sum(v)
+
+    return {'files' : len(profiles),
+            'wall' : total('wall'),
+            'bytes_read' : total('bytes_read'),
+            'bytes_written' : total('bytes_written'),
+            'peak_rss' : max([p['peak_rss'] for p in profiles]) if profiles else None,
+            'peak_rss_scope' : 'file' if all([p.get('peak_rss_scope')=='file' for p in profiles]) else 'process',
+            'lazy_files' : len([p for p in profiles if p.get('lazy')]),
+            'stages' : aggregate('stages'),
+            'diags' : aggregate('diags')}
+
+
+def writereport(f, profiles, options=None):
+    """
+    Write the json report of a batch : OPTIONS of the run, profile of each file and summary.
+    """
+    s=summary(profiles)
+    with open(f, 'w') as fid:
+        json.dump({'options' : options or {}, 'summary' : s, 'files' : profiles}, fid, indent=1)
+
+    print('Profile written in ' + f)
+    print('  {0} files, {1:.2f} s, peak memory {2:.1f} MB'.format(s['files'], s['wall'] or 0., (s['peak_rss'] or 0)/1e6))
+    if s['peak_rss_scope']!='file':
+        print('  (peak memory since the start of each process, it could not be reset for each file)')
+    for group in ['stages','diags']:
+        for n, a in list(s[group].items())[:5]:
+            print('  {0:<8} {1:<30} {2:>10.3f} s'.format(group[:-1], n, a['total']))
+    if s['lazy_files']:
+        print('  (lazy files : diagnostic times only cover the construction of the dask graphs, computations are timed in the write stage)')
@@ -10,16 +10,54 @@
 
 
 import argparse
-from genericpath import isfile
 import os
-from glob import glob
-import xarray as xr
+import numpy as np
+# Heavy modules (xarray, xgcm, DiagIO_NEMOPISCES) are only imported once the inputs are checked, so that the
+# catalogue-only commands (--printlist, --plan, --check) start quickly
 import DiagFunctions_NEMOPISCES as diag
+import DiagIndex_NEMOPISCES as dindex
+import DiagBatch_NEMOPISCES as batch
+import DiagProfile_NEMOPISCES as prof
+import DiagAggregate_NEMOPISCES as agg
 
 # Arguments management #
 parser = argparse.ArgumentParser()
 parser.add_argument("-p","--printlist", help="Just print the list of available diagnostic definitions and required variables", action="store_true")
+parser.add_argument('-c','--catalogue', type=str, default=None, metavar='FILE',
+ help='YAML catalogue of additional diagnostics, declared as expressions of model variables or catalogue entries (requires PyYAML)')
 parser.add_argument("-v","--verbose", help="increase output verbosity", action="store_true")
+parser.add_argument("--plan", nargs='?', const='', default=None, metavar='FILE',
+ help="Just print the execution plan of the diaglist and the estimated peak memory for the grid of FILE (default: the first ptrc file found)")
+parser.add_argument("--check", help="Just index the headers of the input files (cached in DIR/.diag_index.json) and check that they provide the variables required by the diaglist", action="store_true")
+parser.add_argument("--skip-invalid", help="Skip the files that do not provide the variables required by the diaglist, instead of stopping before any computation", action="store_true")
+parser.add_argument("--lazy", help="Open files lazily (chunked) and read only the variables required by the diaglist", action="store_true")
+parser.add_argument("-i","--incremental", help="Skip the diag files that are up to date, compute only the missing diagnostics and append them to existing diag files. Completed files are recorded in DIR/.diag_state.jsonl", action="store_true")
+parser.add_argument('-b','--block', type=int, default=None,
+ help='Number of time records processed at once. Each block is read, computed and written before the next, so that memory depends on the block size rather than on the file length.')
+parser.add_argument('--compress', type=int, default=0, metavar='LEVEL',
+ help='zlib compression level (1-9, with shuffle) of the diagnostics in the diag files')
+parser.add_argument('--float32', help='Store the diagnostics as float32', action="store_true")
+parser.add_argument('--pack', help='Store the diagnostics as int16 packed with scale_factor/add_offset (computed for each file)', action="store_true")
+parser.add_argument('--chunking', choices=['map','series'], default=None,
+ help='Chunk the diagnostics for reading maps (one record per chunk) or time series (all records, 64x64 columns per chunk)')
+parser.add_argument('--zarr', type=str, default=None, metavar='STORE',
+ help='Write the diagnostics of all files in a single zarr store instead of *diag*.nc files. The store is extended if it exists.')
+parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+ help='Write a json report with, for each file, the wall time per stage and per diagnostic, the peak memory and the bytes read and written, and a summary over all files')
+parser.add_argument('--compute-float32', help='Compute the expressions of the catalogue (eg. pocF) in float32', action="store_true")
+parser.add_argument('--wet', help='Compute the diagnostics on the ocean columns only (packed along a single dimension), and scatter them back on the horizontal grid when writing', action="store_true")
+parser.add_argument('-t','--tile', type=int, nargs=2, default=None, metavar=('NY','NX'),
+ help='Compute the diagnostics by horizontal tiles of NY x NX columns, written in their region of the diag file, so that memory does not depend on the grid size')
+parser.add_argument('--tile-workers', type=int, default=1, help='Number of tiles processed concurrently')
+parser.add_argument('--tile-pool', choices=['thread','process'], default='thread', help='Pool used for the tiles')
+parser.add_argument('-a','--aggregate', nargs='+', choices=agg.groupings, default=None,
+ help='Also accumulate the diagnostics of all files by month (climatology), season or year, and write their weighted mean, variance, min, max and count in PREFIX<grouping>.nc at the end (eg. "-a month year")')
+parser.add_argument('--aggregate-prefix', type=str, default=None, metavar='PREFIX',
+ help='Prefix of the aggregate files (default : DIR/aggregate_)')
+parser.add_argument('-w','--workers', type=int, default=1,
+ help='Number of processes handling the file triplets concurrently')
+parser.add_argument('--max-memory', type=str, default=None,
+ help='Memory budget for the files processed concurrently (eg. "64G"). Each file triplet is accounted for by its size on disk.')
 parser.add_argument('-d','--dir', type=str, default='./',
  help='Directory containing the NEMO-PISCES outputs. \n Variable requirements depends on diaglist, but we expect "ptrc","gridT", and "diad" files with the same filename structure')
 parser.add_argument('-k','--key', type=str, default='',
@@ -35,76 +73,150 @@ dlist=args.diaglist
 if args.verbose:
     print("verbose: on")
 
+if args.catalogue is not None:
+    added=diag.loadcatalogue(args.catalogue)
+    if args.verbose:
+        print('Catalogue entries added from ' + args.catalogue + ' : ' + ', '.join(added))
+
 if args.printlist:
     diag.diaglist()
     exit()
     
 
+unknown=[k for k in dlist if k not in diag.ddiag2D]
+if unknown:
+    print('Unknown diagnostics : ' + ', '.join(unknown) + ' (see --printlist)')
+    exit(1)
+
 print('Selected Diags : ')
 diag.diaglist(dlist)
 
 
 
 # Setting up file lists #
-flist_p = glob(indir + '*ptrc*'+key+'*nc')
-if not flist_p:
-    print("Couldn't any files of the form :"+indir + "*ptrc*"+key+"*nc")
-    flist_p = glob(indir +'*' +key+'*ptrc*nc')
-    if not flist_p:
-            print("Couldn't any files of the form :"+indir +'*' +key+'*ptrc*nc')
-
-flist_d = [ f.replace('ptrc','diad') for f in flist_p ] 
-flist_g = [ f.replace('ptrc','gridT') for f in flist_p ] 
-flist_o = [ f.replace('ptrc','diag') for f in flist_p ] 
-
+triplets=dindex.findtriplets(indir, key)
 
 if args.verbose:
     print('Will take care of files : ')
-    print(flist_p)
-
-#TODO test for alternate files (gridT, diad), depending on dependencies and provide meaningfull error message
-
-for i, (fp, fd, fg, fo) in enumerate(zip(flist_p, flist_d, flist_g, flist_o) ):
-    # 1: 'ptrc' files 
-    x_p=xr.load_dataset(fp)
-    xl=[x_p]
-    # 2: 'diad' files 
-    if isfile(fd):
-        x_d=xr.load_dataset(fd)
-        #FIXME TPP is now provided as time instant.
-        # For now I just overwrite and assume time_centered coordinates instead.
-        x_d=x_d.assign(time_counter=x_p['time_counter'].data )
-        x_d=x_d.assign(time_counter_bounds=(('time_counter', 'axis_nbounds'), x_p['time_counter_bounds'].data) ) #FIXME MANIP on origin of time_counter
-        xl.append(x_d)
-    # 3: 'gridT' files 
-    if isfile(fg):
-        x_g=xr.load_dataset(fg)
-        xl.append(x_g)
-
-    # Ensure we got all we may need
-    x_a=xr.merge(xl)
-
-
-    # Need to define a cell height variable to use xgcm 
-    ### 16032022 AC - Had to replace 'depth_bounds' with x_a['deptht'].attrs['bounds']. 
-    ### Maybe similar handling will be needed for other variable names, in which case it should be done in a more organized way
-    x_a['h']=(x_a[x_a['deptht'].attrs['bounds']][:,1:]-x_a[x_a['deptht'].attrs['bounds']][:,:-1]).squeeze()
-    x_a['h'].attrs={'units'     : 'm',
-              'long_name' : 'cells height',
-              'valid_min' : -1e20,
-              'valid_max' : 1e20,
-              'cell_methods' : 'time: mean',
-              'coordinates': 'lon lat deptht'}
-
-    bibi=diag.add2D(x_a,dlist, verbose=args.verbose)
-
-    #FIXME Make the following cleaner.
-    if 'time_centered' in x_a.keys():
-        dlo=dlist+['time_centered']
-    else:
-        dlo=dlist
-        
-    bibi[dlist].to_netcdf(fo)
-
-    print(fo + ' completed')
-    del x_a
\ No newline at end of file
+    print([t[0] for t in triplets])
+
+if args.plan is not None:
+    if not (args.plan or triplets):
+        print('No file to read the grid size from, give one as : --plan FILE')
+        exit()
+    fplan=args.plan if args.plan else triplets[0][0]
+    header=dindex.readheader(fplan)
+    sizes=header['dims']
+    z=None if header['deptht'] is None else np.array(header['deptht'])
+    peak, steps=diag.planmemory(dlist, sizes, z=z)
+    print('Execution plan for grid ' + ' x '.join(['{0}={1}'.format(d,sizes.get(d,1)) for d in ['time_counter','deptht','y','x']]) + ' (' + fplan + ')')
+    for step, m in steps:
+        levels='' if step['levels'] is None else 'levels {0}-{1}'.format(step['levels'].start, step['levels'].stop-1)
+        print( "  {0:<40} {1:<14}".format('+'.join(step['keys']), levels) + "{0:>10.1f} MB".format(m/1e6)
+               + ('   (frees ' + ', '.join(step['drop']) + ')' if step['drop'] else ''))
+    print('Estimated peak memory : {0:.1f} MB'.format(peak/1e6))
+    exit()
+
+# Check the whole file set against the requirements of the diaglist, from the headers only, before loading anything
+index=dindex.buildindex(triplets, cache=os.path.join(indir, '.diag_index.json'), verbose=args.verbose)
+problems=dindex.checkindex(index, dlist)
+if problems:
+    print('Problems found in the inputs :')
+    for fo, p in problems:
+        print('  ' + fo + ' : ' + p)
+if args.check:
+    print('{0} file triplets indexed, {1} with problems'.format(len(triplets), len(set([fo for fo, p in problems]))))
+    exit(1 if problems else 0)
+invalid={}
+for fo, p in problems:
+    invalid.setdefault(fo, []).append(p)
+if invalid:
+    if not args.skip_invalid:
+        print('Nothing processed (use --skip-invalid to process the other files)')
+        exit(1)
+    triplets=[t for t in triplets if t[3] not in invalid]
+
+import DiagIO_NEMOPISCES as dio
+flist_p=[t[0] for t in triplets]
+
+if args.lazy:
+    # Only the variables in the dependency closure of the diaglist are read, when needed
+    keep=diag.requiredvars(dlist)
+    chunks={'time_counter':1}
+    if args.verbose:
+        print('Required variables : ' + ' ; '.join(keep))
+else:
+    keep=None
+    chunks=None
+
+if args.tile is not None and (args.block is not None or args.zarr is not None):
+    print('--tile cannot be combined with --block or --zarr')
+    exit(1)
+
+if args.aggregate is not None and (args.tile is not None or args.incremental):
+    print('--aggregate needs the diagnostics of all files, it cannot be combined with --tile or --incremental')
+    exit(1)
+
+output={'compress':args.compress, 'float32':args.float32, 'pack':args.pack, 'chunking':args.chunking, 'zarr':args.zarr}
+if args.zarr is not None:
+    if args.incremental:
+        print('--incremental applies to diag files and cannot be used with --zarr')
+        exit(1)
+    if args.pack:
+        print('Packing is not available with --zarr, diagnostics are stored as float32')
+        output.update(pack=False, float32=True)
+    try:
+        offsets=dio.preparezarr(flist_p, dlist, output, workers=args.workers)
+    except ValueError as e:
+        print(e)
+        exit(1)
+
+if args.incremental:
+    state=os.path.join(indir, '.diag_state.jsonl')
+    records=dio.readstate(state)
+else:
+    state=None
+
+jobs=[]
+for (fp, fd, fg, fo) in triplets:
+    job={'fp':fp, 'fd':fd, 'fg':fg, 'fo':fo, 'dlist':dlist, 'keep':keep, 'chunks':chunks, 'verbose':args.verbose,
+         'block':args.block, 'output':output, 'profile':args.profile is not None, 'wet':args.wet,
+         'tile':args.tile, 'tileworkers':args.tile_workers, 'tilepool':args.tile_pool, 'aggregate':args.aggregate,
+         'dtype':'float32' if args.compute_float32 else None}
+    if args.incremental:
+        todo, append = dio.missingdiags(fp, fd, fg, fo, dlist, records)
+        if not todo:
+            if args.verbose:
+                print(fo + ' up to date')
+            continue
+        job.update(dlist=todo, keep=diag.requiredvars(todo) if args.lazy else None, append=append, state=state)
+    if args.zarr is not None:
+        job['output']=dict(output, offset=offsets[fp])
+    jobs.append( (fo, job, batch.filesize([fp, fd, fg])) )
+
+if args.incremental:
+    print('{0} files up to date, {1} to process'.format(len(flist_p)-len(jobs), len(jobs)))
+
+# The accumulators of the files are merged as they complete, so that only one is kept
+profiles=[]
+acc=agg.newaccumulator(args.aggregate) if args.aggregate else None
+def collect(r):
+    if r['profile'] is not None:
+        profiles.append(r['profile'])
+    if r['aggregate'] is not None:
+        agg.mergeaccumulators(acc, r['aggregate'])
+
+failures, _ = batch.runbatch(dio.processfiles, jobs, workers=args.workers,
+                        maxmemory=None if args.max_memory is None else batch.parsesize(args.max_memory),
+                        verbose=args.verbose, collect=collect)
+failures+=[(fo, ' ; '.join(p)) for fo, p in invalid.items()]
+batch.report(failures, len(jobs)+len(invalid))
+if acc is not None:
+    if failures:
+        print('Warning : the aggregates do not include the failed files')
+    agg.writeaggregates(acc, args.aggregate_prefix or os.path.join(indir, 'aggregate_'),
+                        encoding=lambda x, dl : dio.outputencoding(x, dl, dict(output, zarr=None)))
+if args.profile is not None:
+    prof.writereport(args.profile, profiles, options=vars(args))
+if failures:
+    exit(1)